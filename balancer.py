@@ -0,0 +1,241 @@
+"""
+COAP Multi-Endpoint Client
+
+Spreads requests over several equivalent CoAP servers. Each endpoint's
+round-trip time and loss are measured from the exchanges sent to it, and
+new exchanges go to the endpoint expected to answer fastest. An endpoint
+that keeps failing is ejected for a while, then given a single trial
+exchange before it takes traffic again. Safe requests that time out are
+retried on the next best endpoint, so a degraded server costs a shortened
+retransmission sequence rather than MAX_TRANSMIT_WAIT.
+
+Blockwise responses are always fetched from one endpoint by client.Client.
+Exchanges that must keep talking to the same server across requests, such
+as Block1 uploads or observations, pass a common affinity key.
+"""
+
+import socket
+import threading
+import time
+from concurrent.futures import Future
+
+import coap
+import client
+import rpc
+
+
+FAILOVER_RETRANSMIT = 1
+"""Retransmissions to one endpoint before an exchange that can be retried
+   on another endpoint fails over. Other exchanges use MAX_RETRANSMIT."""
+
+RTT_ALPHA = 0.125
+"""Weight of a new sample in the smoothed round-trip time."""
+
+LOSS_ALPHA = 0.1
+"""Weight of a new sample in the smoothed loss rate."""
+
+EJECT_AFTER = 2
+"""Consecutive failed exchanges after which an endpoint is ejected."""
+
+EJECT_TIME = 30.0
+"""Seconds an endpoint is ejected for the first time; doubles each time
+   its trial exchange fails, up to MAX_EJECT_TIME."""
+
+MAX_EJECT_TIME = 300.0
+
+
+def isSafeRequest(request):
+    """Default failover predicate: only GET requests are retried elsewhere."""
+    return request.code == coap.GET
+
+
+class Endpoint(object):
+    """Health and latency estimates for one server."""
+
+    def __init__(self, address):
+        self.address = address
+        self.srtt = None
+        """Smoothed round-trip time in seconds, None until measured."""
+        self.loss = 0.0
+        """Smoothed fraction of datagrams that had to be retransmitted."""
+        self.inflight = 0
+        self.failures = 0
+        """Consecutive failed exchanges."""
+        self.ejected_until = None
+        self.eject_time = EJECT_TIME
+        self.probing = False
+        """True while the trial exchange after an ejection is outstanding."""
+
+    def available(self, now):
+        return self.ejected_until is None or (now >= self.ejected_until and not self.probing)
+
+    def score(self):
+        """Expected time to complete one more exchange; lower is better.
+           Unmeasured endpoints score 0 so they are tried first."""
+        if self.srtt is None:
+            return 0.0
+        return self.srtt * (1 + self.inflight) / (1.0 - min(self.loss, 0.9))
+
+    def __repr__(self):
+        return "Endpoint({}, srtt={}, loss={:.2f}, ejected={})".format(
+            self.address, self.srtt, self.loss, self.ejected_until is not None)
+
+
+class BalancedClient(object):
+    """A client.Client that routes each exchange to the best of several
+       endpoints, given as (host, port) pairs. Every endpoint is resolved
+       up front so failing over never waits on name resolution."""
+
+    def __init__(self, addresses, block_policy=None, family=socket.AF_INET, failover=isSafeRequest,
+                 max_retransmit=FAILOVER_RETRANSMIT, clock=time.time):
+        if not addresses:
+            raise ValueError("At least one endpoint address is required")
+        self.client = client.Client(block_policy=block_policy, family=family)
+        try:
+            # Client caches the results, so later requests never resolve.
+            for address in addresses:
+                self.client.resolve(address)
+        except socket.error:
+            self.client.close()
+            raise
+        self.endpoints = [Endpoint(address) for address in addresses]
+        self.failover = failover
+        self.max_retransmit = max_retransmit
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._affinity = {}  # key -> Endpoint
+
+    def close(self):
+        self.client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _select(self, exclude=(), affinity=None):
+        """Choose an endpoint and count the exchange against it."""
+        now = self.clock()
+        with self._lock:
+            endpoint = self._affinity.get(affinity) if affinity is not None else None
+            if endpoint is not None and (endpoint in exclude or endpoint.ejected_until is not None):
+                endpoint = None
+            if endpoint is None:
+                candidates = [e for e in self.endpoints if e not in exclude and e.available(now)]
+                if candidates:
+                    # Endpoints that have just failed go last until they succeed again.
+                    endpoint = min(candidates, key=lambda e: (e.failures, e.score()))
+                else:
+                    # Everything is ejected; the one due back soonest is the best bet.
+                    candidates = [e for e in self.endpoints if e not in exclude] or self.endpoints
+                    endpoint = min(candidates, key=lambda e: e.ejected_until or 0.0)
+                if affinity is not None:
+                    self._affinity[affinity] = endpoint
+            if endpoint.ejected_until is not None and now >= endpoint.ejected_until:
+                endpoint.probing = True
+            endpoint.inflight += 1
+        return endpoint
+
+    def release(self, affinity):
+        """Forget the endpoint chosen for affinity."""
+        with self._lock:
+            self._affinity.pop(affinity, None)
+
+    def request(self, msg, affinity=None):
+        """Send msg to the best endpoint and return a Future for the
+           response. Requests that share an affinity key go to the same
+           endpoint for as long as it stays healthy."""
+        future = Future()
+        self._attempt(msg, future, affinity, [])
+        return future
+
+    def _attempt(self, msg, future, affinity, tried):
+        endpoint = self._select(tried, affinity)
+        tried.append(endpoint)
+        started = self.clock()
+        # Only shorten retransmission when there is another endpoint to fail over to.
+        if self.failover(msg) and len(tried) < len(self.endpoints):
+            max_retransmit = self.max_retransmit
+        else:
+            max_retransmit = coap.MAX_RETRANSMIT
+        try:
+            upstream = self.client.request(msg.clone(), endpoint.address, max_retransmit)
+        except ValueError as e:
+            self._record(endpoint, started, None)
+            client._settle(future, exception=e)
+            return
+
+        def done(upstream):
+            try:
+                response = upstream.result()
+            except client.ExchangeTimeout as e:
+                self._record(endpoint, started, None)
+                if affinity is not None:
+                    self.release(affinity)
+                if self.failover(msg) and len(tried) < len(self.endpoints):
+                    self._attempt(msg, future, affinity, tried)
+                else:
+                    client._settle(future, exception=e)
+                return
+            except Exception as e:
+                self._record(endpoint, started, None)
+                client._settle(future, exception=e)
+                return
+            self._record(endpoint, started, response)
+            response.endpoint = endpoint.address
+            client._settle(future, response)
+        upstream.add_done_callback(done)
+
+    def _record(self, endpoint, started, response):
+        """Update endpoint estimates with the outcome of one exchange;
+           response is None if it failed."""
+        now = self.clock()
+        with self._lock:
+            endpoint.inflight -= 1
+            endpoint.probing = False
+            if response is None:
+                endpoint.loss += LOSS_ALPHA * (1.0 - endpoint.loss)
+                endpoint.failures += 1
+                if endpoint.ejected_until is not None:
+                    endpoint.eject_time = min(endpoint.eject_time * 2, MAX_EJECT_TIME)
+                    endpoint.ejected_until = now + endpoint.eject_time
+                elif endpoint.failures >= EJECT_AFTER:
+                    endpoint.ejected_until = now + endpoint.eject_time
+                return
+            endpoint.failures = 0
+            endpoint.ejected_until = None
+            endpoint.eject_time = EJECT_TIME
+            transmissions = getattr(response, 'transmissions', 1)
+            retransmissions = getattr(response, 'retransmissions', 0)
+            sample = retransmissions / float(max(transmissions, 1))
+            endpoint.loss += LOSS_ALPHA * (sample - endpoint.loss)
+            if retransmissions == 0:
+                # Karn's algorithm: only unambiguous exchanges are timed.
+                rtt = (now - started) / max(transmissions, 1)
+                if endpoint.srtt is None:
+                    endpoint.srtt = rtt
+                else:
+                    endpoint.srtt += RTT_ALPHA * (rtt - endpoint.srtt)
+
+    def get(self, path, query=(), affinity=None, timeout=None):
+        """GET path and return the response Message."""
+        msg = coap.Message(code=coap.GET)
+        msg.opt.uri_path = path
+        msg.opt.uri_query = query
+        return self.request(msg, affinity).result(timeout)
+
+    def post(self, path, payload, query=(), content_format=None, affinity=None, timeout=None):
+        """POST payload to path and return the response Message."""
+        msg = coap.Message(code=coap.POST, payload=payload)
+        msg.opt.uri_path = path
+        msg.opt.uri_query = query
+        if content_format is not None:
+            msg.opt.content_format = content_format
+        return self.request(msg, affinity).result(timeout)
+
+    def rpc(self, builder, calls, affinity=None, timeout=None):
+        """Send calls built with rpc.RequestBuilder to /rpc and return the
+           decoded list of call responses."""
+        response = self.request(builder.message(calls, mid=0), affinity).result(timeout)
+        return rpc.decodeResponse(response)
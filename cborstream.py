@@ -0,0 +1,268 @@
+"""
+Incremental CBOR Decoding
+
+A push-style CBOR (RFC 7049) decoder that accepts data in arbitrary chunks,
+such as the payloads of successive Block2 responses, and hands back selected
+nested items as soon as their last byte has arrived. Items that are handed
+back are not retained in their parent container, so peak memory is bounded
+by the largest single item rather than by the whole document.
+
+A matching encoder, dumps(), produces the same definite-length, shortest-form
+encoding as cbor.dumps and passes Raw values through untouched so that
+pre-encoded fragments can be spliced into larger documents.
+"""
+
+import struct
+
+
+_BREAK = object()
+_NOKEY = object()
+
+_ARG_SIZES = {24: 1, 25: 2, 26: 4, 27: 8}
+_ARG_STRUCTS = {1: struct.Struct('!B'), 2: struct.Struct('!H'),
+                4: struct.Struct('!I'), 8: struct.Struct('!Q')}
+_FLOAT_STRUCTS = {25: struct.Struct('!e'), 26: struct.Struct('!f'), 27: struct.Struct('!d')}
+_SIMPLE_VALUES = {20: False, 21: True, 22: None, 23: None}
+
+
+class CBORDecodeError(ValueError):
+    """Raised when the input is not well-formed CBOR."""
+
+
+class Raw(bytes):
+    """Already-encoded CBOR that dumps() copies to its output verbatim."""
+
+
+def encodeHead(major, arg):
+    """Encode a major type and argument in the shortest form."""
+    if arg < 24:
+        return _ARG_STRUCTS[1].pack((major << 5) | arg)
+    for (info, size) in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if arg < 1 << (size * 8):
+            return _ARG_STRUCTS[1].pack((major << 5) | info) + _ARG_STRUCTS[size].pack(arg)
+    raise ValueError("Integer too large for CBOR head: {}".format(arg))
+
+
+def dumps(value):
+    """Encode value as CBOR bytes."""
+    out = bytearray()
+    _encode(value, out)
+    return bytes(out)
+
+
+def _encode(value, out):
+    if isinstance(value, Raw):
+        out += value
+    elif value is None:
+        out.append(0xF6)
+    elif value is True:
+        out.append(0xF5)
+    elif value is False:
+        out.append(0xF4)
+    elif isinstance(value, int):
+        if value >= 0:
+            out += encodeHead(0, value)
+        else:
+            out += encodeHead(1, -1 - value)
+    elif isinstance(value, float):
+        out.append(0xFB)
+        out += _FLOAT_STRUCTS[27].pack(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        out += encodeHead(2, len(value))
+        out += value
+    elif isinstance(value, str):
+        raw = value.encode('utf-8')
+        out += encodeHead(3, len(raw))
+        out += raw
+    elif isinstance(value, (list, tuple)):
+        out += encodeHead(4, len(value))
+        for item in value:
+            _encode(item, out)
+    elif isinstance(value, dict):
+        out += encodeHead(5, len(value))
+        for key, item in value.items():
+            _encode(key, out)
+            _encode(item, out)
+    else:
+        raise TypeError("Cannot encode {} as CBOR".format(type(value).__name__))
+
+
+class _Frame(object):
+    """An array, map, tag or indefinite-length string under construction."""
+
+    __slots__ = ('major', 'remaining', 'value', 'key', 'path', 'index', 'tag')
+
+    def __init__(self, major, remaining, value, path, tag=None):
+        self.major = major
+        self.remaining = remaining  # None for indefinite length
+        self.value = value
+        self.key = _NOKEY
+        self.path = path
+        self.index = 0
+        self.tag = tag
+
+
+class IncrementalDecoder(object):
+    """Decode a single CBOR document fed in chunks.
+
+       emit is a predicate called with the path of every completed item;
+       items for which it returns True are returned from feed()
+       as (path, value) pairs once complete, instead of being stored in
+       their parent. A path is a tuple of array indices and map keys from
+       the root, e.g. (0, 'result', 3)."""
+
+    def __init__(self, emit=None):
+        self._emit = emit or (lambda path: False)
+        self._buf = bytearray()
+        self._stack = []
+        self._done = False
+        self.value = None
+        """The root item once the document is complete."""
+
+    def _complete(self):
+        return self._done
+    complete = property(_complete)
+
+    def feed(self, data):
+        """Add data and return a list of (path, value) for each selected
+           item completed by it."""
+        if self._done and data:
+            raise CBORDecodeError("Data after end of CBOR document")
+        self._buf += data
+        out = []
+        buf = self._buf
+        pos = 0
+        end = len(buf)
+        while not self._done and pos < end:
+            ib = buf[pos]
+            major = ib >> 5
+            info = ib & 0x1F
+            size = _ARG_SIZES.get(info, 0)
+            if info > 27 and (info != 31 or major in (0, 1, 6)):
+                raise CBORDecodeError("Invalid additional information {}".format(info))
+            if pos + 1 + size > end:
+                break
+            if size:
+                arg = _ARG_STRUCTS[size].unpack_from(buf, pos + 1)[0]
+            else:
+                arg = info
+            start = pos + 1 + size
+
+            if major in (2, 3) and info != 31:
+                if start + arg > end:
+                    break
+                raw = bytes(buf[start:start + arg])
+                pos = start + arg
+                self._item(raw if major == 2 else raw.decode('utf-8'), out)
+                continue
+
+            pos = start
+            if major == 0:
+                self._item(arg, out)
+            elif major == 1:
+                self._item(-1 - arg, out)
+            elif major in (2, 3):
+                self._push(_Frame(major, None, [], self._childPath()))
+            elif major in (4, 5):
+                path = self._childPath()
+                remaining = None if info == 31 else arg
+                frame = _Frame(major, remaining, [] if major == 4 else {}, path)
+                self._push(frame)
+                if remaining == 0:
+                    self._pop(out)
+            elif major == 6:
+                # Only bignums change the decoded value; other tags are transparent.
+                if arg in (2, 3):
+                    self._push(_Frame(major, 1, None, self._childPath(), tag=arg))
+            elif info in _FLOAT_STRUCTS:
+                self._item(_FLOAT_STRUCTS[info].unpack_from(buf, start - size)[0], out)
+            elif info == 31:
+                self._item(_BREAK, out)
+            elif info in _SIMPLE_VALUES:
+                self._item(_SIMPLE_VALUES[info], out)
+            else:
+                self._item(arg, out)
+        if self._done and pos < end:
+            raise CBORDecodeError("Data after end of CBOR document")
+        del buf[:pos]
+        return out
+
+    def _push(self, frame):
+        self._stack.append(frame)
+
+    def _childPath(self):
+        """Path of the item about to start, or None if it is a map key or
+           part of an indefinite-length string."""
+        if not self._stack:
+            return ()
+        frame = self._stack[-1]
+        if frame.path is None or frame.major in (2, 3, 6):
+            return None
+        if frame.major == 4:
+            return frame.path + (frame.index,)
+        if frame.major == 5:
+            return None if frame.key is _NOKEY else frame.path + (frame.key,)
+        return frame.path
+
+    def _item(self, value, out):
+        """Deliver a finished item to the innermost open frame."""
+        if value is _BREAK:
+            if not self._stack or self._stack[-1].remaining is not None:
+                raise CBORDecodeError("Unexpected break")
+            self._pop(out)
+            return
+        path = self._childPath()
+        if path is not None and self._emit(path):
+            out.append((path, value))
+            self._advance(out, None, stored=False)
+        else:
+            self._advance(out, value, stored=True)
+
+    def _advance(self, out, value, stored):
+        if not self._stack:
+            self.value = value
+            self._done = True
+            return
+        frame = self._stack[-1]
+        if frame.major == 4:
+            if stored:
+                frame.value.append(value)
+            frame.index += 1
+        elif frame.major == 5:
+            if frame.key is _NOKEY:
+                frame.key = value
+                return
+            if stored:
+                frame.value[frame.key] = value
+            frame.key = _NOKEY
+        elif frame.major == 6:
+            if not isinstance(value, bytes):
+                raise CBORDecodeError("Bignum tag must enclose a byte string")
+            value = int.from_bytes(value, 'big')
+            frame.value = value if frame.tag == 2 else -1 - value
+        else:
+            if not isinstance(value, bytes if frame.major == 2 else str):
+                raise CBORDecodeError("Invalid chunk in indefinite-length string")
+            frame.value.append(value)
+            return
+        if frame.remaining is not None:
+            frame.remaining -= 1
+            if frame.remaining == 0:
+                self._pop(out)
+
+    def _pop(self, out):
+        """Close the innermost frame and deliver it to its parent."""
+        frame = self._stack.pop()
+        if frame.major == 2:
+            value = b''.join(frame.value)
+        elif frame.major == 3:
+            value = ''.join(frame.value)
+        elif frame.major == 5 and frame.key is not _NOKEY:
+            raise CBORDecodeError("Map ended between key and value")
+        else:
+            value = frame.value
+        if frame.path is not None and self._emit(frame.path):
+            out.append((frame.path, value))
+            self._advance(out, None, stored=False)
+        else:
+            self._advance(out, value, stored=True)
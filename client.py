@@ -0,0 +1,332 @@
+"""
+Thread-Safe COAP Client
+
+A client that multiplexes requests from any number of threads over one UDP
+socket. A single background I/O thread matches responses to requests by
+token, retransmits confirmable requests and follows Block2 responses to the
+end. Block1 is not implemented, so request payloads must fit in one
+datagram. Requests are put on the wire through a
+scheduler.TransmitScheduler, so each server sees at most NSTART outstanding
+requests, higher priority requests go first and unresponsive servers are
+paced to PROBING_RATE. Callers either block in get()/post()/rpc() or use
+request() to get a concurrent.futures.Future.
+"""
+
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+import coap
+import rpc
+import scheduler
+
+
+class ExchangeTimeout(Exception):
+    """Raised when an exchange gets no response."""
+
+
+class ExchangeReset(Exception):
+    """Raised when the server rejects a request with a Reset message."""
+
+
+def _settle(future, result=None, exception=None):
+    """Complete future unless its caller has already cancelled it."""
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class _Exchange(object):
+    """A request awaiting its (possibly blockwise) response."""
+
+    __slots__ = ('request', 'address', 'future', 'data', 'deadline', 'timeout', 'attempts', 'max_retransmit',
+                 'priority', 'body', 'transmissions', 'retransmissions')
+
+    def __init__(self, request, address, future, max_retransmit, priority):
+        self.request = request
+        self.address = address
+        self.future = future
+        self.max_retransmit = max_retransmit
+        self.priority = priority
+        self.data = None
+        self.deadline = None
+        self.timeout = None
+        self.attempts = 0
+        self.body = bytearray()
+        self.transmissions = 0
+        self.retransmissions = 0
+
+
+class Client(object):
+    """Thread-safe CoAP client backed by one socket and one I/O thread.
+
+       address is the default (host, port) for requests that do not name
+       one; hosts are resolved once and remembered. Each response carries
+       the number of datagrams sent for its exchange in transmissions and
+       how many of those were retransmissions in retransmissions.
+       nstart is the number of requests allowed outstanding per server."""
+
+    def __init__(self, address=None, block_policy=None, family=socket.AF_INET, nstart=coap.NSTART):
+        self.family = family
+        self.default_address = address
+        self.block_policy = block_policy
+        self.scheduler = scheduler.TransmitScheduler(nstart=nstart)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.bind(('', 0))
+        self.sock.setblocking(False)
+        self._lock = threading.Lock()
+        self._exchanges = {}
+        self._addresses = {}
+        self._mid = random.randint(0, 0xFFFF)
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, name='coap-client')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        """Stop the I/O thread; outstanding requests fail."""
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup_w.send(b'\0')
+        self._thread.join()
+        self.sock.close()
+        with self._lock:
+            exchanges = list(self._exchanges.values())
+            self._exchanges.clear()
+        for exchange in exchanges:
+            _settle(exchange.future, exception=ExchangeTimeout("Client closed"))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def resolve(self, address=None):
+        """Resolve (host, port) to a socket address, caching the result."""
+        if address is None:
+            address = self.default_address
+        if address is None:
+            raise ValueError("No address given and no default address set")
+        resolved = self._addresses.get(address)
+        if resolved is None:
+            info = socket.getaddrinfo(address[0], address[1], self.family, socket.SOCK_DGRAM)
+            resolved = self._addresses[address] = info[0][4]
+        return resolved
+
+    def request(self, msg, address=None, max_retransmit=coap.MAX_RETRANSMIT, priority=scheduler.NORMAL):
+        """Send msg confirmable and return a Future for the response, with
+           the payloads of all Block2 responses joined. The Message ID and
+           token are assigned by the client; each datagram of the exchange
+           is retransmitted up to max_retransmit times. priority is one of
+           the scheduler priority classes."""
+        address = self.resolve(address)
+        future = Future()
+        msg.mtype = coap.CON
+        if self.block_policy is not None and msg.opt.block2 is None:
+            msg.opt.block2 = (0, 0, self.block_policy.sizeExponent(address))
+        exchange = _Exchange(msg, address, future, max_retransmit, priority)
+        with self._lock:
+            if not self._running:
+                raise ValueError("Client is closed")
+            token = os.urandom(4)
+            while token in self._exchanges:
+                token = os.urandom(4)
+            msg.token = token
+            self._exchanges[token] = exchange
+            self._transmit(exchange)
+        self._wakeup_w.send(b'\0')
+        return future
+
+    def get(self, path, query=(), address=None, timeout=None, priority=scheduler.NORMAL):
+        """GET path and return the response Message."""
+        msg = coap.Message(code=coap.GET)
+        msg.opt.uri_path = path
+        msg.opt.uri_query = query
+        return self.request(msg, address, priority=priority).result(timeout)
+
+    def post(self, path, payload, query=(), content_format=None, address=None, timeout=None,
+             priority=scheduler.NORMAL):
+        """POST payload to path and return the response Message."""
+        msg = coap.Message(code=coap.POST, payload=payload)
+        msg.opt.uri_path = path
+        msg.opt.uri_query = query
+        if content_format is not None:
+            msg.opt.content_format = content_format
+        return self.request(msg, address, priority=priority).result(timeout)
+
+    def rpc(self, builder, calls, address=None, timeout=None):
+        """Send calls built with rpc.RequestBuilder to /rpc and return the
+           decoded list of call responses."""
+        response = self.request(builder.message(calls, mid=0), address).result(timeout)
+        return rpc.decodeResponse(response)
+
+    def _transmit(self, exchange):
+        """Give the exchange's request a new Message ID and queue it; it
+           is sent once the scheduler releases it."""
+        self._mid = (self._mid + 1) & 0xFFFF
+        exchange.request.mid = self._mid
+        exchange.data = None
+        exchange.timeout = None
+        exchange.deadline = None
+        exchange.attempts = 0
+        self.scheduler.submit(exchange.request, exchange.address, exchange.priority)
+
+    def _flush(self, now):
+        """Send every request the scheduler releases. Called with the
+           lock held."""
+        for item in self.scheduler.poll():
+            exchange = self._exchanges[item.msg.token]
+            exchange.data = item.data
+            exchange.timeout = coap.ACK_TIMEOUT * random.uniform(1, coap.ACK_RANDOM_FACTOR)
+            exchange.deadline = now + exchange.timeout
+            exchange.transmissions += 1
+            self._send(exchange)
+
+    def _send(self, exchange):
+        try:
+            self.sock.sendto(exchange.data, exchange.address)
+        except socket.error as e:
+            # Retransmission will try again, asking for smaller blocks if
+            # the policy shrinks the block size (see _expire).
+            if self.block_policy is not None:
+                self.block_policy.onSendError(exchange.address, e)
+
+    def _refit(self, exchange):
+        """Before a retransmission, re-encode the request under a new
+           Message ID if the policy has shrunk the block size since it was
+           encoded; the same byte offset is asked for in smaller blocks."""
+        block2 = exchange.request.opt.block2
+        if self.block_policy is None or block2 is None:
+            return
+        wanted = self.block_policy.sizeExponent(exchange.address)
+        if wanted >= block2.size_exponent:
+            return
+        number = block2.block_number * 2 ** (block2.size_exponent - wanted)
+        exchange.request.opt.block2 = (number, 0, wanted)
+        self._mid = (self._mid + 1) & 0xFFFF
+        exchange.request.mid = self._mid
+        exchange.data = exchange.request.encode()
+
+    def _loop(self):
+        while self._running:
+            with self._lock:
+                now = time.time()
+                self._flush(now)
+                waits = [e.deadline - now for e in self._exchanges.values() if e.deadline is not None]
+                paced = self.scheduler.timeout()
+                if paced is not None:
+                    waits.append(paced)
+            wait = max(0.0, min(waits)) if waits else None
+            readable, _, _ = select.select([self.sock, self._wakeup_r], [], [], wait)
+            if self._wakeup_r in readable:
+                try:
+                    while self._wakeup_r.recv(64):
+                        pass
+                except (BlockingIOError, socket.error):
+                    pass
+            if self.sock in readable:
+                while True:
+                    try:
+                        data, remote = self.sock.recvfrom(65535)
+                    except (BlockingIOError, socket.error):
+                        break
+                    self._received(data, remote)
+            self._expire(time.time())
+
+    def _received(self, data, remote):
+        try:
+            response = coap.Message.decode(data, remote=remote)
+        except (ValueError, IndexError, struct.error):
+            return
+        if response.mtype == coap.CON:
+            self.sock.sendto(coap.Message(mtype=coap.ACK, mid=response.mid).encode(), remote)
+        if response.mtype == coap.RST:
+            self._reset(response)
+            return
+        with self._lock:
+            if response.code == coap.EMPTY:
+                # An empty ACK: the response will follow separately.
+                for exchange in self._exchanges.values():
+                    if exchange.request.mid == response.mid and response.mtype == coap.ACK:
+                        exchange.timeout = None
+                        exchange.deadline = time.time() + coap.EXCHANGE_LIFETIME
+                return
+            exchange = self._exchanges.get(response.token)
+            if exchange is None:
+                return
+            if response.mtype == coap.ACK and response.mid != exchange.request.mid:
+                return  # acknowledges an earlier block request
+            block2 = response.opt.block2
+            offset = 0 if block2 is None else block2.block_number * 2 ** (block2.size_exponent + 4)
+            if offset != len(exchange.body):
+                return  # duplicate or out-of-order block
+            if self.block_policy is not None:
+                self.block_policy.onResponse(exchange.address, response)
+            exchange.body += response.payload
+            if block2 is not None and block2.more:
+                number = block2.block_number + 1
+                size_exp = block2.size_exponent
+                if self.block_policy is not None:
+                    wanted = self.block_policy.sizeExponent(exchange.address)
+                    if wanted < size_exp:
+                        number *= 2 ** (size_exp - wanted)
+                        size_exp = wanted
+                exchange.request.opt.block2 = (number, 0, size_exp)
+                # Each block is its own request and competes for the NSTART
+                # slot again, so urgent requests can overtake a transfer.
+                self.scheduler.complete(exchange.address)
+                self._transmit(exchange)
+                return
+            del self._exchanges[response.token]
+            self.scheduler.complete(exchange.address)
+        response.payload = bytes(exchange.body)
+        response.opt.deleteOption(coap.BLOCK2)
+        response.transmissions = exchange.transmissions
+        response.retransmissions = exchange.retransmissions
+        _settle(exchange.future, response)
+
+    def _reset(self, rst):
+        """Fail the exchange whose current request rst rejects."""
+        with self._lock:
+            for token, exchange in self._exchanges.items():
+                if exchange.data is not None and exchange.request.mid == rst.mid:
+                    del self._exchanges[token]
+                    self.scheduler.complete(exchange.address)
+                    break
+            else:
+                return
+        _settle(exchange.future, exception=ExchangeReset("Request reset by {}:{}".format(*exchange.address[:2])))
+
+    def _expire(self, now):
+        failed = []
+        with self._lock:
+            for token, exchange in list(self._exchanges.items()):
+                if exchange.deadline is None or now < exchange.deadline:
+                    continue
+                if exchange.attempts >= exchange.max_retransmit or exchange.timeout is None:
+                    del self._exchanges[token]
+                    self.scheduler.complete(exchange.address, responded=False)
+                    failed.append(exchange)
+                    continue
+                exchange.attempts += 1
+                exchange.transmissions += 1
+                exchange.retransmissions += 1
+                exchange.timeout *= 2
+                exchange.deadline = now + exchange.timeout
+                self._refit(exchange)
+                self._send(exchange)
+        for exchange in failed:
+            _settle(exchange.future, exception=ExchangeTimeout("No response from {}:{}".format(*exchange.address[:2])))
@@ -9,13 +9,20 @@ Exosite, LLC and are released in the MIT License.
 """
 
 import random
-import copy
+import errno
 import struct
 import collections
 import binascii
+import functools
+from bisect import insort
 from itertools import chain
 
 
+_HEADER = struct.Struct('!BBH')
+_UINT8 = struct.Struct('!B')
+_UINT16 = struct.Struct('!H')
+
+
 COAP_PORT = 5683
 """The IANA-assigned standard port for COAP services."""
 
@@ -47,6 +54,14 @@ NSTART = 1
 """Maximum number of simultaneous outstanding interactions
    that endpoint maintains to a given server (including proxies)"""
 
+DEFAULT_LEISURE = 5.0
+"""Upper bound, in seconds, of the random delay before a server
+   responds to a multicast request."""
+
+PROBING_RATE = 1.0
+"""Average data rate, in bytes per second, that must not be exceeded
+   when sending to an endpoint that does not respond."""
+
 #   +-------------------+---------------+
 #   | name              | default value |
 #   +-------------------+---------------+
@@ -84,8 +99,27 @@ EXCHANGE_LIFETIME = MAX_TRANSMIT_SPAN + MAX_RTT
  message to the time when an acknowledgement is no longer expected,
 i.e. message layer information about the message exchange can be purged"""
 
-DEFAULT_BLOCK_SIZE_EXP = 2  # Block size 64
-"""Default size exponent for blockwise transfers."""
+NON_LIFETIME = MAX_TRANSMIT_SPAN + MAX_LATENCY
+"""Time from sending a non-confirmable message to the time its
+Message ID can be safely reused."""
+
+MAX_BLOCK_SIZE_EXP = 6  # Block size 1024
+"""Largest size exponent allowed by the Block options."""
+
+DEFAULT_BLOCK_SIZE_EXP = MAX_BLOCK_SIZE_EXP
+"""Default size exponent for blockwise transfers. Peers offering larger
+   blocks are renegotiated down to this size; see BlockSizePolicy for
+   choosing it per endpoint."""
+
+DEFAULT_PATH_MTU = 1280
+"""Path MTU assumed when none is known (the IPv6 minimum)."""
+
+UDP_IP_OVERHEAD = 48
+"""Bytes of IPv6 and UDP header in every datagram."""
+
+MAX_HEADER_OVERHEAD = 128
+"""Room left in a datagram for the CoAP header, token and options
+   when choosing a block size."""
 
 EMPTY_ACK_DELAY = 0.1
 """After this time protocol sends empty ACK, and separate response"""
@@ -177,7 +211,7 @@ responses = {65: '2.01 Created',
 
 responses_rev = {v:k for k, v in responses.items()}
 
-codes = dict({0: "EMPTY"}.items() + requests.items() + responses.items())
+codes = dict(chain({0: "EMPTY"}.items(), requests.items(), responses.items()))
 
 codes_rev = {v:k for k, v in codes.items()}
 
@@ -276,10 +310,81 @@ Token:         {}
 Payload:       ({} bytes)
 {}"""
 
+DATAGRAM_OK = 0
+REJECT_TRUNCATED_HEADER = 1
+REJECT_BAD_VERSION = 2
+REJECT_BAD_TOKEN_LENGTH = 3
+REJECT_TRUNCATED_TOKEN = 4
+REJECT_BAD_EMPTY_MESSAGE = 5
+REJECT_RESERVED_OPTION_NIBBLE = 6
+REJECT_TRUNCATED_OPTION = 7
+REJECT_EMPTY_PAYLOAD = 8
+
+rejects = {0: 'OK',
+           1: 'Truncated header',
+           2: 'Unsupported version',
+           3: 'Token length over 8',
+           4: 'Truncated token',
+           5: 'Empty message with token, options or payload',
+           6: 'Reserved option delta or length nibble',
+           7: 'Truncated option',
+           8: 'Payload marker followed by empty payload'}
+"""Reasons returned by validate()."""
+
+
+def validate(rawdata):
+    """Check the structure of a datagram in one pass without decoding it.
+
+       Returns DATAGRAM_OK (0), or one of the REJECT_* codes in rejects, so
+       that malformed traffic can be dropped before any objects are created.
+       A datagram passing validation can be decoded by Message.decode."""
+    end = len(rawdata)
+    if end < 4:
+        return REJECT_TRUNCATED_HEADER
+    first = rawdata[0]
+    if first >> 6 != 1:
+        return REJECT_BAD_VERSION
+    token_length = first & 0x0F
+    if token_length > 8:
+        return REJECT_BAD_TOKEN_LENGTH
+    if rawdata[1] == EMPTY:
+        return DATAGRAM_OK if end == 4 and token_length == 0 else REJECT_BAD_EMPTY_MESSAGE
+    pos = 4 + token_length
+    if pos > end:
+        return REJECT_TRUNCATED_TOKEN
+    while pos < end:
+        byte = rawdata[pos]
+        pos += 1
+        if byte == 0xFF:
+            return DATAGRAM_OK if pos < end else REJECT_EMPTY_PAYLOAD
+        delta = byte >> 4
+        length = byte & 0x0F
+        if delta == 15 or length == 15:
+            return REJECT_RESERVED_OPTION_NIBBLE
+        if delta == 13:
+            pos += 1
+        elif delta == 14:
+            pos += 2
+        if length == 13:
+            if pos >= end:
+                return REJECT_TRUNCATED_OPTION
+            length = rawdata[pos] + 13
+            pos += 1
+        elif length == 14:
+            if pos + 2 > end:
+                return REJECT_TRUNCATED_OPTION
+            length = ((rawdata[pos] << 8) | rawdata[pos + 1]) + 269
+            pos += 2
+        pos += length
+        if pos > end:
+            return REJECT_TRUNCATED_OPTION
+    return DATAGRAM_OK
+
+
 class Message(object):
     """A CoAP Message."""
 
-    def __init__(self, mtype=None, mid=None, code=EMPTY, payload='', token=''):
+    def __init__(self, mtype=None, mid=None, code=EMPTY, payload=b'', token=b''):
         self.version = 1
         self.mtype = mtype
         self.mid = mid
@@ -294,7 +399,7 @@ class Message(object):
         self.postpath = None
 
         if self.payload is None:
-            raise TypeError("Payload must not be None. Use empty string instead.")
+            raise TypeError("Payload must not be None. Use empty bytes instead.")
 
     def __str__(self):
         return MESSAGE_FORMAT.format(self.version,
@@ -303,24 +408,36 @@ class Message(object):
                                      codes[self.code],
                                      "{}.{:02}".format(self.code >> 5, self.code & 0x1f),
                                      self.mid,
-                                     self.token or "<None>",
+                                     "0x" + binascii.b2a_hex(self.token).decode('ascii') if self.token else "<None>",
                                      self.opt.__str__(),
                                      len(self.payload),
                                      self.payload)
 
 
     @classmethod
-    def decode(cls, rawdata, remote=None, protocol=None):
-        """Create Message object from binary representation of message."""
-        (vttkl, code, mid) = struct.unpack('!BBH', rawdata[:4])
+    def decode(cls, rawdata, remote=None, protocol=None, pool=None):
+        """Create Message object from binary representation of message.
+           rawdata may be bytes, bytearray or memoryview; it is not copied
+           until the token, option values and payload are extracted.
+           If a MessagePool is given the message and its options are taken
+           from it and should be handed back with pool.release()."""
+        rawdata = memoryview(rawdata)
+        if len(rawdata) < 4:
+            raise ValueError("Fatal Error: Message shorter than header")
+        (vttkl, code, mid) = _HEADER.unpack_from(rawdata)
         version = (vttkl & 0xC0) >> 6
-        if version is not 1:
+        if version != 1:
             raise ValueError("Fatal Error: Protocol Version must be 1")
         mtype = (vttkl & 0x30) >> 4
         token_length = (vttkl & 0x0F)
-        msg = Message(mtype=mtype, mid=mid, code=code)
-        msg.token = rawdata[4:4 + token_length]
-        msg.payload = msg.opt.decode(rawdata[4 + token_length:])
+        if token_length > 8 or 4 + token_length > len(rawdata):
+            raise ValueError("Fatal Error: Invalid token length")
+        if pool is None:
+            msg = Message(mtype=mtype, mid=mid, code=code)
+        else:
+            msg = pool.message(mtype, mid, code)
+        msg.token = rawdata[4:4 + token_length].tobytes()
+        msg.payload = msg.opt.decode(rawdata[4 + token_length:], pool)
         msg.remote = remote
         msg.protocol = protocol
         return msg
@@ -329,14 +446,31 @@ class Message(object):
         """Create binary representation of message from Message object."""
         if self.mtype is None or self.mid is None:
             raise TypeError("Fatal Error: Message Type and Message ID must not be None.")
-        rawdata = chr((self.version << 6) + ((self.mtype & 0x03) << 4) + (len(self.token) & 0x0F))
-        rawdata += struct.pack('!BH', self.code, self.mid)
+        rawdata = bytearray(_HEADER.pack((self.version << 6) + ((self.mtype & 0x03) << 4) + (len(self.token) & 0x0F),
+                                         self.code, self.mid))
         rawdata += self.token
         rawdata += self.opt.encode()
         if len(self.payload) > 0:
-            rawdata += chr(0xFF)
+            rawdata.append(0xFF)
             rawdata += self.payload
-        return rawdata
+        return bytes(rawdata)
+
+    def clone(self, payload=None):
+        """Return a copy of this message sharing the payload and option
+           objects with it. The option lists are copied on write, so
+           setting options on either message does not affect the other.
+           If payload is given it replaces the payload of the copy."""
+        msg = Message(mtype=self.mtype, mid=self.mid, code=self.code,
+                      payload=self.payload if payload is None else payload, token=self.token)
+        msg.version = self.version
+        msg.opt = self.opt.copy()
+        msg.response_type = self.response_type
+        msg.remote = self.remote
+        msg.prepath = self.prepath
+        msg.postpath = self.postpath
+        if hasattr(self, 'protocol'):
+            msg.protocol = self.protocol
+        return msg
 
     def extractBlock(self, number, size_exp):
         """Extract block from current message."""
@@ -344,8 +478,7 @@ class Message(object):
         start = number * size
         if start < len(self.payload):
             end = start + size if start + size < len(self.payload) else len(self.payload)
-            block = copy.deepcopy(self)
-            block.payload = block.payload[start:end]
+            block = self.clone(payload=self.payload[start:end])
             block.mid = None
             more = True if end < len(self.payload) else False
             if isRequest(block.code):
@@ -389,15 +522,15 @@ class Message(object):
         else:
             raise ValueError("Fatal Error: called appendResponseBlock on non-response message!!!")
 
-    def generateNextBlock2Request(self, response):
+    def generateNextBlock2Request(self, response, size_exp=DEFAULT_BLOCK_SIZE_EXP):
         """Generate a request for next response block.
            This method is used by client after receiving
-           blockwise response from server with "more" flag set."""
-        request = copy.deepcopy(self)
-        request.payload = ""
+           blockwise response from server with "more" flag set.
+           Blocks larger than size_exp are renegotiated down to it."""
+        request = self.clone(payload=b"")
         request.mid = None
-        if response.opt.block2.block_number == 0 and response.opt.block2.size_exponent > DEFAULT_BLOCK_SIZE_EXP:
-            new_size_exponent = DEFAULT_BLOCK_SIZE_EXP
+        if response.opt.block2.block_number == 0 and response.opt.block2.size_exponent > size_exp:
+            new_size_exponent = size_exp
             new_block_number = 2 ** (response.opt.block2.size_exponent - new_size_exponent)
             request.opt.block2 = (new_block_number, False, new_size_exponent)
         else:
@@ -406,14 +539,15 @@ class Message(object):
         request.opt.deleteOption(OBSERVE)
         return request
 
-    def generateNextBlock1Response(self):
+    def generateNextBlock1Response(self, size_exp=DEFAULT_BLOCK_SIZE_EXP):
         """Generate a response to acknowledge incoming request block.
            This method is used by server after receiving
-           blockwise request from client with "more" flag set."""
+           blockwise request from client with "more" flag set.
+           Blocks larger than size_exp are renegotiated down to it."""
         response = Message(code=CHANGED, token=self.token )
         response.remote = self.remote
-        if self.opt.block1.block_number == 0 and self.opt.block1.size_exponent > DEFAULT_BLOCK_SIZE_EXP:
-            new_size_exponent = DEFAULT_BLOCK_SIZE_EXP
+        if self.opt.block1.block_number == 0 and self.opt.block1.size_exponent > size_exp:
+            new_size_exponent = size_exp
             response.opt.block1 = (0, True, new_size_exponent)
         else:
             response.opt.block1 = (self.opt.block1.block_number, True, self.opt.block1.size_exponent)
@@ -423,68 +557,109 @@ class Options(object):
     """Represent CoAP Header Options."""
     def __init__(self):
         self._options = {}
+        self._numbers = []
+        self._shared = False
+
+    def copy(self):
+        """Return a copy sharing the option lists with this one until either
+           adds to them. Option objects are never modified in place, so they
+           are shared for good."""
+        options = Options()
+        options._options = dict(self._options)
+        options._numbers = list(self._numbers)
+        options._shared = self._shared = True
+        return options
 
     def __str__(self):
         return "\n".join([opt.__str__() for opt in self.optionList()])
 
-    def decode(self, rawdata):
-        """Decode all options in message from raw binary data."""
+    def decode(self, rawdata, pool=None):
+        """Decode all options in message from raw binary data.
+           Returns the payload following the options as bytes.
+           Option objects and lists are taken from pool if given."""
+        rawdata = memoryview(rawdata)
         option_number = 0
-
-        while len(rawdata) > 0:
-            if ord(rawdata[0]) == 0xFF:
-                return rawdata[1:]
-            dllen = ord(rawdata[0])
-            delta = (dllen & 0xF0) >> 4
-            length = (dllen & 0x0F)
-            rawdata = rawdata[1:]
-            (delta, rawdata) = readExtendedFieldValue(delta, rawdata)
-            (length, rawdata) = readExtendedFieldValue(length, rawdata)
+        pos = 0
+        end = len(rawdata)
+
+        while pos < end:
+            dllen = rawdata[pos]
+            if dllen == 0xFF:
+                if pos + 1 == end:
+                    raise ValueError("Payload marker followed by empty payload")
+                return rawdata[pos + 1:].tobytes()
+            pos += 1
+            (delta, pos) = readExtendedFieldValue((dllen & 0xF0) >> 4, rawdata, pos)
+            (length, pos) = readExtendedFieldValue(dllen & 0x0F, rawdata, pos)
+            if pos + length > end:
+                raise ValueError("Option overruns end of message")
             option_number += delta
-            option = option_formats.get(option_number, StringOption)(option_number)
-            option.decode(rawdata[:length])
-            self.addOption(option)
-            rawdata = rawdata[length:]
-        return ''
+            if pool is None:
+                option = option_formats.get(option_number, StringOption)(option_number)
+                option.decode(rawdata[pos:pos + length])
+                self.addOption(option)
+            else:
+                option = pool.decodeOption(option_number, rawdata[pos:pos + length])
+                option_list = self._options.get(option_number)
+                if option_list is None:
+                    # Option numbers never decrease, so this one is the largest.
+                    option_list = self._options[option_number] = pool.optionList()
+                    self._numbers.append(option_number)
+                option_list.append(option)
+            pos += length
+        return b''
 
     def encode(self):
-        """Encode all options in option header into string of bytes."""
-        data = []
+        """Encode all options in option header into bytes.
+           Runs of options listed in cached_option_numbers are looked up in
+           an LRU cache of encoded runs instead of being encoded again."""
+        data = bytearray()
         current_opt_num = 0
-        option_list = self.optionList()
-        for option in option_list:
-            delta, extended_delta = writeExtendedFieldValue(option.number - current_opt_num)
-            length, extended_length = writeExtendedFieldValue(option.length)
-            data.append(chr(((delta & 0x0F) << 4) + (length & 0x0F)))
-            data.append(extended_delta)
-            data.append(extended_length)
-            data.append(option.encode())
-            current_opt_num = option.number
-        return (''.join(data))
+        for number in self._numbers:
+            option_list = self._options[number]
+            if number in cached_option_numbers:
+                data += _encodeOptionRun(current_opt_num, number,
+                                         tuple([(option.__class__, option.value) for option in option_list]))
+            else:
+                for option in option_list:
+                    _appendOption(data, option.number - current_opt_num, option.encode())
+                    current_opt_num = option.number
+            current_opt_num = number
+        return bytes(data)
 
     def addOption(self, option):
         """Add option into option header."""
-        self._options.setdefault(option.number, []).append(option)
+        option_list = self._options.get(option.number)
+        if option_list is None:
+            self._options[option.number] = [option]
+            insort(self._numbers, option.number)
+        elif self._shared:
+            self._options[option.number] = option_list + [option]
+        else:
+            option_list.append(option)
 
     def deleteOption(self, number):
         """Delete option from option header."""
         if number in self._options:
             self._options.pop(number)
+            self._numbers.remove(number)
 
     def getOption (self, number):
         """Get option with specified number."""
         return self._options.get(number)
 
     def optionList(self):
-        return chain.from_iterable(sorted(self._options.values(), key=lambda x: x[0].number))
+        return chain.from_iterable([self._options[number] for number in self._numbers])
 
     def _setUriPath(self, segments):
         """Convenience setter: Uri-Path option"""
-        if isinstance(segments, basestring): #For Python >3.1 replace with isinstance(segments,str)
+        if isinstance(segments, (str, bytes, bytearray)):
             raise ValueError("URI Path should be passed as a list or tuple of segments")
         self.deleteOption(number=URI_PATH)
         for segment in segments:
-            self.addOption(StringOption(number=URI_PATH, value=str(segment)))
+            if isinstance(segment, (bytearray, memoryview)):
+                segment = bytes(segment)  # the interning cache needs a hashable key
+            self.addOption(internedStringOption(URI_PATH, segment))
 
     def _getUriPath(self):
         """Convenience getter: Uri-Path option"""
@@ -499,11 +674,13 @@ class Options(object):
 
     def _setUriQuery(self, segments):
         """Convenience setter: Uri-Query option"""
-        if isinstance(segments, basestring): #For Python >3.1 replace with isinstance(segments,str)
+        if isinstance(segments, (str, bytes, bytearray)):
             raise ValueError("URI Query should be passed as a list or tuple of segments")
         self.deleteOption(number=URI_QUERY)
         for segment in segments:
-            self.addOption(StringOption(number=URI_QUERY, value=str(segment)))
+            if isinstance(segment, (bytearray, memoryview)):
+                segment = bytes(segment)  # the interning cache needs a hashable key
+            self.addOption(internedStringOption(URI_QUERY, segment))
 
     def _getUriQuery(self):
         """Convenience getter: Uri-Query option"""
@@ -616,16 +793,124 @@ class Options(object):
 
     accept = property(_getAccept, _setAccept)
 
+    def _setMaxAge(self, max_age):
+        self.deleteOption(number=MAX_AGE)
+        if max_age is not None:
+            self.addOption(UintOption(number=MAX_AGE, value=max_age))
+
+    def _getMaxAge(self):
+        max_age = self.getOption(number=MAX_AGE)
+        if max_age is not None:
+            return max_age[0].value
+        else:
+            return None
+
+    max_age = property(_getMaxAge, _setMaxAge)
+
+    def _setUriHost(self, uri_host):
+        self.deleteOption(number=URI_HOST)
+        if uri_host is not None:
+            self.addOption(StringOption(number=URI_HOST, value=uri_host))
+
+    def _getUriHost(self):
+        uri_host = self.getOption(number=URI_HOST)
+        if uri_host is not None:
+            return uri_host[0].value
+        else:
+            return None
+
+    uri_host = property(_getUriHost, _setUriHost)
+
+    def _setUriPort(self, uri_port):
+        self.deleteOption(number=URI_PORT)
+        if uri_port is not None:
+            self.addOption(UintOption(number=URI_PORT, value=uri_port))
+
+    def _getUriPort(self):
+        uri_port = self.getOption(number=URI_PORT)
+        if uri_port is not None:
+            return uri_port[0].value
+        else:
+            return None
 
-def readExtendedFieldValue(value, rawdata):
+    uri_port = property(_getUriPort, _setUriPort)
+
+    def _setProxyUri(self, proxy_uri):
+        self.deleteOption(number=PROXY_URI)
+        if proxy_uri is not None:
+            self.addOption(StringOption(number=PROXY_URI, value=proxy_uri))
+
+    def _getProxyUri(self):
+        proxy_uri = self.getOption(number=PROXY_URI)
+        if proxy_uri is not None:
+            return proxy_uri[0].value
+        else:
+            return None
+
+    proxy_uri = property(_getProxyUri, _setProxyUri)
+
+    def _setProxyScheme(self, proxy_scheme):
+        self.deleteOption(number=PROXY_SCHEME)
+        if proxy_scheme is not None:
+            self.addOption(StringOption(number=PROXY_SCHEME, value=proxy_scheme))
+
+    def _getProxyScheme(self):
+        proxy_scheme = self.getOption(number=PROXY_SCHEME)
+        if proxy_scheme is not None:
+            return proxy_scheme[0].value
+        else:
+            return None
+
+    proxy_scheme = property(_getProxyScheme, _setProxyScheme)
+
+
+cached_option_numbers = frozenset([URI_HOST, URI_PORT, URI_PATH, CONTENT_FORMAT, URI_QUERY, ACCEPT])
+"""Options whose encoded runs are cached by Options.encode. These usually
+   come from a small, fixed set of values, unlike e.g. Block2 or ETag."""
+
+OPTION_CACHE_SIZE = 1024
+"""Entries kept in each of the interned option and encoded run caches."""
+
+
+def _appendOption(data, delta, value):
+    """Append one encoded option to the bytearray data."""
+    delta, extended_delta = writeExtendedFieldValue(delta)
+    length, extended_length = writeExtendedFieldValue(len(value))
+    data.append(((delta & 0x0F) << 4) + (length & 0x0F))
+    data += extended_delta
+    data += extended_length
+    data += value
+
+
+@functools.lru_cache(maxsize=OPTION_CACHE_SIZE)
+def _encodeOptionRun(previous_number, number, values):
+    """Encoded bytes for options number with values, a tuple of (option
+       class, value) pairs, following an option numbered previous_number."""
+    data = bytearray()
+    for (option_class, value) in values:
+        _appendOption(data, number - previous_number, option_class(number, value).encode())
+        previous_number = number
+    return bytes(data)
+
+
+@functools.lru_cache(maxsize=OPTION_CACHE_SIZE)
+def internedStringOption(number, value):
+    """A shared StringOption for a recurring (number, value) pair."""
+    option = StringOption(number, value)
+    option.interned = True
+    return option
+
+
+def readExtendedFieldValue(value, rawdata, pos):
     """Used to decode large values of option delta and option length
-       from raw binary form."""
+       from raw binary form. Returns the value and the position of the
+       first byte following it."""
     if value >= 0 and value < 13:
-        return (value, rawdata)
-    elif value == 13:
-        return (ord(rawdata[0]) + 13, rawdata[1:])
-    elif value == 14:
-        return (struct.unpack('!H', rawdata[:2])[0] + 269, rawdata[2:])
+        return (value, pos)
+    elif value == 13 and pos < len(rawdata):
+        return (rawdata[pos] + 13, pos + 1)
+    elif value == 14 and pos + 2 <= len(rawdata):
+        return (_UINT16.unpack_from(rawdata, pos)[0] + 269, pos + 2)
     else:
         raise ValueError("Value out of range.")
 
@@ -636,11 +921,11 @@ def writeExtendedFieldValue(value):
        In CoAP option delta and length can be represented by a variable
        number of bytes depending on the value."""
     if value >= 0 and value < 13:
-        return (value, '')
+        return (value, b'')
     elif value >= 13 and value < 269:
-        return (13, struct.pack('!B', value - 13))
+        return (13, _UINT8.pack(value - 13))
     elif value >= 269 and value < 65804:
-        return (14, struct.pack('!H', value - 269))
+        return (14, _UINT16.pack(value - 269))
     else:
         raise ValueError("Value out of range.")
 
@@ -654,16 +939,25 @@ OPTION_FORMAT = \
       NCacheK: {}"""
 
 class StringOption(object):
-    """String CoAP option - used to represent string and opaque options."""
+    """String CoAP option - used to represent string and opaque options.
+       Values are stored as bytes; other values are converted with str()
+       and encoded as UTF-8."""
 
-    def __init__(self, number, value=""):
-        self.value = value
+    interned = False
+    """True for options shared through internedStringOption or by a
+       MessagePool; a MessagePool never recycles those."""
+
+    def __init__(self, number, value=b""):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            self.value = bytes(value)
+        else:
+            self.value = str(value).encode('utf-8')
         self.number = number
 
     def __str__(self):
         return OPTION_FORMAT.format(options[self.number],
                                     self.number,
-                                    self.value if isValidUTF8(self.value) else "0x"+binascii.b2a_hex(self.value),
+                                    self.value.decode('utf-8') if isValidUTF8(self.value) else "0x" + binascii.b2a_hex(self.value).decode('ascii'),
                                     self.critical(),
                                     self.unsafe(),
                                     self.nocachekey())
@@ -673,7 +967,7 @@ class StringOption(object):
         return rawdata
 
     def decode(self, rawdata):
-        self.value = rawdata  # if rawdata is not None else ""
+        self.value = bytes(rawdata)
 
     def critical(self):
         return self.number & 1 == 1
@@ -705,14 +999,10 @@ class UintOption(object):
                                     self.nocachekey())
 
     def encode(self):
-        rawdata = struct.pack("!L", self.value)  # For Python >3.1 replace with int.to_bytes()
-        return rawdata.lstrip(chr(0))
+        return self.value.to_bytes(self.length, 'big')
 
-    def decode(self, rawdata):  # For Python >3.1 replace with int.from_bytes()
-        value = 0
-        for byte in rawdata:
-            value = (value * 256) + ord(byte)
-        self.value = value
+    def decode(self, rawdata):
+        self.value = int.from_bytes(rawdata, 'big')
         return self
 
     def critical(self):
@@ -751,15 +1041,14 @@ class BlockOption(object):
                                     self.unsafe(),
                                     self.nocachekey())
 
+    def _asInteger(self):
+        return (self.value[0] << 4) + (self.value[1] * 0x08) + self.value[2]
+
     def encode(self):
-        as_integer = (self.value[0] << 4) + (self.value[1] * 0x08) + self.value[2]
-        rawdata = struct.pack("!L", as_integer)  # For Python >3.1 replace with int.to_bytes()
-        return rawdata.lstrip(chr(0))
+        return self._asInteger().to_bytes(self.length, 'big')
 
     def decode(self, rawdata):
-        as_integer = 0
-        for byte in rawdata:
-            as_integer = (as_integer * 256) + ord(byte)
+        as_integer = int.from_bytes(rawdata, 'big')
         self.value = self.BlockwiseTuple(block_number=(as_integer >> 4), more=((as_integer >> 3) & 0x01), size_exponent=(as_integer & 0x07))
 
     def critical(self):
@@ -773,7 +1062,7 @@ class BlockOption(object):
 
 
     def _length(self):
-        return ((self.value[0].bit_length() + 3) / 8 + 1)
+        return (self._asInteger().bit_length() + 7) // 8
     length = property(_length)
 
 option_formats = {6: UintOption,
@@ -781,12 +1070,166 @@ option_formats = {6: UintOption,
                   12: UintOption,
                   14: UintOption,
                   16: UintOption,
+                  17: UintOption,
                   23: BlockOption,
                   27: BlockOption,
-                  28: UintOption}
+                  28: UintOption,
+                  60: UintOption}
 """Dictionary used to assign option type to option numbers."""
 
 
+class MessagePool(object):
+    """Free lists of Message, option and option list objects for an opt-in,
+       low-allocation receive path.
+
+       Messages from decode() are reset and reused once passed to
+       release(); nothing taken from a released message (its Options, an
+       option object or list) may be used afterwards. Option lists shared
+       with a clone are left to the clone. String options seen before,
+       such as a device's Uri-Path and CIK, are shared between messages
+       instead of being copied out of each datagram. A pool is not
+       thread-safe; use one per receiving thread."""
+
+    def __init__(self, max_free=256, max_values=1024):
+        self.max_free = max_free
+        self.max_values = max_values
+        self._messages = []
+        self._lists = []
+        self._options = {StringOption: [], UintOption: [], BlockOption: []}
+        self._strings = {}  # number -> {value: interned StringOption}
+        self._string_count = 0
+
+    def decode(self, rawdata, remote=None, protocol=None):
+        """Message.decode using pooled objects."""
+        return Message.decode(rawdata, remote, protocol, pool=self)
+
+    def message(self, mtype, mid, code):
+        """A reset Message with an empty Options."""
+        if not self._messages:
+            return Message(mtype=mtype, mid=mid, code=code)
+        msg = self._messages.pop()
+        msg.mtype = mtype
+        msg.mid = mid
+        msg.code = code
+        return msg
+
+    def decodeOption(self, number, rawdata):
+        """An option object of the right format for number with its value
+           decoded from rawdata, a memoryview."""
+        cls = option_formats.get(number, StringOption)
+        if cls is StringOption and rawdata.readonly:
+            # A read-only memoryview hashes and compares like bytes, so a
+            # known option is found without copying its value first.
+            strings = self._strings.get(number)
+            if strings is None:
+                strings = self._strings[number] = {}
+            option = strings.get(rawdata)
+            if option is not None:
+                return option
+            if self._string_count < self.max_values:
+                option = StringOption(number, rawdata)
+                option.interned = True
+                strings[option.value] = option
+                self._string_count += 1
+                return option
+        free = self._options[cls]
+        if free:
+            option = free.pop()
+            option.number = number
+        else:
+            option = cls(number)
+        option.decode(rawdata)
+        return option
+
+    def optionList(self):
+        return self._lists.pop() if self._lists else []
+
+    def release(self, msg):
+        """Return msg and its options to the pool."""
+        options = msg.opt
+        if options._shared:
+            msg.opt = Options()
+        else:
+            for option_list in options._options.values():
+                for option in option_list:
+                    free = self._options.get(type(option))
+                    if free is not None and len(free) < self.max_free and not getattr(option, 'interned', False):
+                        free.append(option)
+                del option_list[:]
+                if len(self._lists) < self.max_free:
+                    self._lists.append(option_list)
+            options._options.clear()
+            del options._numbers[:]
+        msg.version = 1
+        msg.token = b''
+        msg.payload = b''
+        msg.response_type = None
+        msg.remote = None
+        msg.prepath = None
+        msg.postpath = None
+        msg.protocol = None
+        if len(self._messages) < self.max_free:
+            self._messages.append(msg)
+
+
+class BlockSizePolicy(object):
+    """Chooses and remembers the block size exponent (SZX) per endpoint.
+
+       Every endpoint starts at the largest block that fits the path MTU,
+       is shrunk when a datagram is too large for the path or the peer
+       answers 4.13 Request Entity Too Large, and follows a peer that
+       negotiates smaller blocks."""
+
+    def __init__(self, path_mtu=DEFAULT_PATH_MTU):
+        self.initial_size_exp = sizeExponentForMTU(path_mtu)
+        self._size_exps = {}
+
+    def sizeExponent(self, endpoint):
+        """SZX to use for the next transfer with endpoint."""
+        return self._size_exps.get(endpoint, self.initial_size_exp)
+
+    def shrink(self, endpoint, size_exp=None):
+        """Use smaller blocks with endpoint: size_exp if given and smaller,
+           otherwise half the current size."""
+        current = self.sizeExponent(endpoint)
+        if size_exp is None:
+            size_exp = current - 1
+        self._size_exps[endpoint] = max(0, min(current, size_exp))
+        return self._size_exps[endpoint]
+
+    def onResponse(self, endpoint, response):
+        """Learn from a response received from endpoint."""
+        if response.code == REQUEST_ENTITY_TOO_LARGE:
+            # Always shrink: a Block1 in the 4.13 may name a size no
+            # smaller than the one that was just refused.
+            size_exp = self.sizeExponent(endpoint) - 1
+            block1 = response.opt.block1
+            if block1 is not None:
+                size_exp = min(size_exp, block1.size_exponent)
+            self.shrink(endpoint, size_exp)
+            return
+        for block in (response.opt.block1, response.opt.block2):
+            if block is not None and block.size_exponent < self.sizeExponent(endpoint):
+                self._size_exps[endpoint] = block.size_exponent
+
+    def onSendError(self, endpoint, error):
+        """Learn from a socket error raised sending to endpoint; EMSGSIZE
+           means the datagram did not fit the path."""
+        if getattr(error, 'errno', None) == errno.EMSGSIZE:
+            self.shrink(endpoint)
+            return True
+        return False
+
+
+def sizeExponentForMTU(path_mtu):
+    """Largest SZX whose blocks, with headers, fit in one datagram."""
+    room = path_mtu - UDP_IP_OVERHEAD - MAX_HEADER_OVERHEAD
+    size_exp = MAX_BLOCK_SIZE_EXP
+    while size_exp > 0 and 2 ** (size_exp + 4) > room:
+        size_exp -= 1
+    return size_exp
+
+
 def isRequest(code):
     return True if (code >= 1 and code < 32) else False
 
@@ -800,7 +1243,8 @@ def isSuccessful(code):
 
 
 def uriPathAsString(segment_list):
-    return '/' + '/'.join(segment_list)
+    return '/' + '/'.join(segment.decode('utf-8') if isinstance(segment, bytes) else segment
+                          for segment in segment_list)
 
 def isValidUTF8(to_check):
     try:
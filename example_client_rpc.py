@@ -2,17 +2,13 @@
 A more complicated demo of using the RPC proxy to access Exosite's JSON RPC API
 using CoAP and CBOR.
 
-To use this example you will need to make sure you have run:
-
-  pip install cbor
-
 Author: Patrick Barrett(patrickbarrett@exosite.com)
 """
 
 import socket
 import binascii
 import coap
-import cbor
+import rpc
 
 # Update these parameters with the CIK of the deice and the alias of the
 # datasource that you'd like to read.
@@ -25,35 +21,14 @@ PORT = 5683
 
 # This is in the standard format for the RPC API, see
 # http://docs.exosite.com/rpc
-read_call = {
-	"procedure": "read",
-	"arguments": [
-		{"alias": ALIAS},
-		{"limit": 1}
-	],
-	"id": 1
-}
-
-request = {
-	"auth" : {
-		"cik": CIK
-	},
-	"calls": [ read_call ]
-}
-
-# Create a New Conformable GET CoAP Request with Message ID 0x37.
-msg = coap.Message(mtype=coap.CON, mid=0x37, code=coap.POST)
+# The builder caches the CBOR encoding of the auth envelope and the fixed
+# parts of each call, so only the arguments are encoded per request.
+builder = rpc.RequestBuilder(CIK)
+read_call = builder.call("read", [rpc.aliasArgument(ALIAS), {"limit": 1}], 1)
 
-# Set the path where the format is "/rpc/".
-msg.opt.uri_path = ('rpc',  )
-
-# Add Content Format Option
-msg.opt.content_format = 60 #application/cbor
-
-# Encode Request as CBOR and Put in Payload
-msg.payload = cbor.dumps(request)
-
-print(request)
+# Create a New Conformable POST CoAP Request to "/rpc/" with Message ID 0x37,
+# carrying the Request Encoded as CBOR.
+msg = builder.message([read_call], mid=0x37)
 
 print("------------ Send Message ------------")
 print(msg)
@@ -62,38 +37,16 @@ print(msg)
 sock = socket.socket(socket.AF_INET, # Internet
                      socket.SOCK_DGRAM) # UDP
 
-# Encode and Send Message
-sock.sendto(msg.encode(), (SERVER, PORT))
-
-body = b""
-
-while True:
-	# Wait for Response
-	data, addr = sock.recvfrom(2048) # maximum packet size is 1500 bytes
-
-	# Decode and Display Response
-	recv_msg = coap.Message.decode(data)
-	print("------------ Recv Message ------------")
-	print(recv_msg)
-	body += recv_msg.payload
-
-	# Only Continue Requests if Sever Says There's More
-	if recv_msg.opt.block2 == None or recv_msg.opt.block2[1] == 0:
-		break
-
-	# Update Request to Ask for Next Block
-	msg.opt.block2 = (recv_msg.opt.block2[0] + 1, 0, recv_msg.opt.block2[2])
-
-	# Encode and Send Message
-	sock.sendto(msg.encode(), (SERVER, PORT))
-
-# Decode CBOR Response to Python Object
-response = cbor.loads(body)
-
-# Print the RPC Response in JSON-like Format
-print("RPC Response:")
-print(response)
-
-# Print Just the Value of the dataport
-print("Dataport Value:")
-print(response[0]['result'][0][1])
+# Send the request, following Block2 responses, and decode each call's
+# response as soon as its last block arrives rather than after the whole body.
+# The policy asks for the largest blocks that fit in one datagram.
+payloads = rpc.blockwisePayloads(sock, msg, (SERVER, PORT), policy=coap.BlockSizePolicy())
+
+for path, value in rpc.iterResponse(payloads, datapoints=True):
+	if len(path) == 3:
+		# Print Each Datapoint of the Read as Soon as It Is Complete
+		print("Datapoint:", value)
+	else:
+		# Print the RPC Response in JSON-like Format
+		print("RPC Response:")
+		print(value)
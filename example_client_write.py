@@ -25,7 +25,7 @@ msg.opt.uri_path = ('1a', ALIAS,)
 # Encode the CIK to binary to save data
 msg.opt.uri_query = (binascii.a2b_hex(CIK),)
 
-msg.payload = "37"
+msg.payload = b"37"
 
 
 print("------------ Send Message ------------")
@@ -0,0 +1,34 @@
+"""
+A simple demo of serving CoAP resources with the server module.
+
+Stores the last value written to /1a/<alias> and returns it on GET.
+"""
+
+import coap
+import server
+
+PORT = 5683
+
+
+class Datasources(server.Resource):
+	# Every path below /1a is handled here, the alias is in request.postpath.
+	isLeaf = True
+
+	def __init__(self):
+		self.values = {}
+
+	def render_GET(self, request):
+		if tuple(request.postpath) not in self.values:
+			return coap.Message(code=coap.NOT_FOUND)
+		return coap.Message(code=coap.CONTENT, payload=self.values[tuple(request.postpath)])
+
+	def render_POST(self, request):
+		self.values[tuple(request.postpath)] = request.payload
+		return coap.Message(code=coap.CHANGED)
+
+
+tree = server.ResourceTree()
+tree.putChild(('1a', ), Datasources())
+
+print("Serving on port {}".format(PORT))
+server.Server(tree, address=('', PORT)).serveForever()
@@ -0,0 +1,171 @@
+"""
+COAP Forward Proxy
+
+A CoAP-to-CoAP forward proxy resource for server.Server. Requests name
+their target with Proxy-Uri, or with Proxy-Scheme plus the Uri-Host,
+Uri-Port, Uri-Path and Uri-Query options.
+
+Identical cacheable requests that arrive while one is already in flight
+upstream are collapsed onto it, and the single upstream response is fanned
+out to every waiting client. Successful responses are then served from a
+cache for their Max-Age, so upstream traffic grows with the number of
+distinct resources rather than the number of clients.
+"""
+
+import collections
+import socket
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import urlsplit, unquote_to_bytes
+
+import coap
+import client
+import server
+
+
+DEFAULT_MAX_AGE = 60
+"""Max-Age assumed for responses that do not carry the option."""
+
+MAX_CACHE_ENTRIES = 1024
+"""Responses kept in the cache before the least recently used is evicted."""
+
+_FORWARDED_OPTIONS = (coap.URI_HOST, coap.URI_PORT, coap.URI_PATH, coap.URI_QUERY,
+                      coap.PROXY_URI, coap.PROXY_SCHEME, coap.BLOCK1, coap.BLOCK2)
+"""Options rewritten by the proxy rather than copied to the upstream request."""
+
+
+def isSafeRequest(request):
+    """Default cacheable predicate: only GET requests are collapsed and cached."""
+    return request.code == coap.GET
+
+
+class ForwardProxy(server.Resource):
+    """Proxy resource with request collapsing and a Max-Age bounded cache.
+
+       cacheable decides which requests may be collapsed and cached; by
+       default only GET. Requests to /rpc that only read can be opted in
+       by passing a predicate that recognises them."""
+
+    def __init__(self, upstream=None, cacheable=isSafeRequest, max_entries=MAX_CACHE_ENTRIES):
+        self.upstream = upstream if upstream is not None else client.Client()
+        """The client.Client used for upstream exchanges."""
+        self.cacheable = cacheable
+        self.max_entries = max_entries
+        self.upstream_requests = 0
+        self.cache_hits = 0
+        self.collapsed = 0
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()  # key -> (response, expiry)
+        self._inflight = {}  # key -> Future
+
+    def render(self, request):
+        target = self._target(request)
+        if isinstance(target, coap.Message):
+            return target
+        (host, port, path, query) = target
+        try:
+            address = self.upstream.resolve((host, port))
+        except socket.error:
+            return coap.Message(code=coap.BAD_GATEWAY)
+
+        forward = coap.Message(mtype=coap.CON, code=request.code, payload=request.payload)
+        for option in request.opt.optionList():
+            if option.number not in _FORWARDED_OPTIONS:
+                forward.opt.addOption(option)
+        forward.opt.uri_path = path
+        forward.opt.uri_query = query
+
+        if not self.cacheable(request):
+            self.upstream_requests += 1
+            return self._fanout(self.upstream.request(forward, address))
+
+        key = (request.code, address, tuple(path), tuple(query), request.opt.accept,
+               tuple(request.opt.etags), request.payload)
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                (response, expiry) = cached
+                if expiry > now:
+                    self._cache.move_to_end(key)
+                    self.cache_hits += 1
+                    downstream = response.clone()
+                    downstream.opt.max_age = int(expiry - now)
+                    return downstream
+                del self._cache[key]
+            future = self._inflight.get(key)
+            if future is not None:
+                self.collapsed += 1
+                return self._fanout(future)
+            self.upstream_requests += 1
+            future = self._inflight[key] = self.upstream.request(forward, address)
+        future.add_done_callback(lambda f: self._store(key, f))
+        return self._fanout(future)
+
+    def _target(self, request):
+        """(host, port, path segments, query segments) for request, or an
+           error response. Segments are bytes, as decoded Uri-Path and
+           Uri-Query options are, so binary values such as a CIK survive
+           percent-decoding and both request forms share cache keys."""
+        proxy_uri = request.opt.proxy_uri
+        if proxy_uri is not None:
+            try:
+                uri = urlsplit(proxy_uri.decode('utf-8'))
+                port = uri.port
+            except (UnicodeDecodeError, ValueError):
+                return coap.Message(code=coap.BAD_OPTION)
+            if uri.scheme != 'coap':
+                return coap.Message(code=coap.PROXYING_NOT_SUPPORTED)
+            if not uri.hostname:
+                return coap.Message(code=coap.BAD_OPTION)
+            # RFC 7252 section 6.4: a path of "" or "/" has no Uri-Path options.
+            path = []
+            if uri.path not in ('', '/'):
+                path = [unquote_to_bytes(segment) for segment in uri.path.split('/')[1:]]
+            query = [unquote_to_bytes(segment) for segment in uri.query.split('&')] if uri.query else []
+            return (uri.hostname, port or coap.COAP_PORT, path, query)
+
+        if request.opt.proxy_scheme != b'coap':
+            return coap.Message(code=coap.PROXYING_NOT_SUPPORTED)
+        host = request.opt.uri_host
+        if host is None:
+            return coap.Message(code=coap.BAD_OPTION)
+        return (host.decode('utf-8', 'replace'), request.opt.uri_port or coap.COAP_PORT,
+                request.opt.uri_path, request.opt.uri_query)
+
+    def _fanout(self, upstream):
+        """A Future resolving to a private copy of the upstream response,
+           so each waiting client can be answered independently."""
+        downstream = Future()
+
+        def done(future):
+            try:
+                response = future.result()
+            except client.ExchangeTimeout:
+                downstream.set_result(coap.Message(code=coap.GATEWAY_TIMEOUT))
+                return
+            except Exception:
+                downstream.set_result(coap.Message(code=coap.BAD_GATEWAY))
+                return
+            downstream.set_result(response.clone())
+        upstream.add_done_callback(done)
+        return downstream
+
+    def _store(self, key, future):
+        with self._lock:
+            self._inflight.pop(key, None)
+            if future.exception() is not None:
+                return
+            response = future.result()
+            if response.code != coap.CONTENT:
+                return
+            max_age = response.opt.max_age
+            if max_age is None:
+                max_age = DEFAULT_MAX_AGE
+            if max_age <= 0:
+                return
+            self._cache[key] = (response, time.time() + max_age)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
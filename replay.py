@@ -0,0 +1,325 @@
+"""
+COAP Capture Reading and Replay
+
+Streams CoAP messages out of pcap and pcapng packet captures without loading
+the whole file into memory, and re-sends captured requests against a server
+with their original (or scaled) timing.
+"""
+
+import collections
+import mmap
+import socket
+import struct
+import time
+
+import coap
+
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_BYTE_ORDER_MAGIC = 0x1a2b3c4d
+
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_VLAN = (0x8100, 0x88A8, 0x9100)
+
+IPPROTO_UDP = 17
+
+_MID = struct.Struct('!H')
+
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+"""Hop-by-hop, routing and destination option headers; fragments are not followed."""
+
+
+class Datagram(object):
+    """A single UDP payload carved out of a capture."""
+
+    __slots__ = ('timestamp', 'src', 'dst', 'data')
+
+    def __init__(self, timestamp, src, dst, data):
+        self.timestamp = timestamp
+        self.src = src
+        self.dst = dst
+        self.data = data
+
+
+def readDatagrams(path, port=coap.COAP_PORT):
+    """Yield a Datagram for every UDP packet in a pcap/pcapng file with
+       port as either source or destination port (all UDP if port is None).
+       The file is memory-mapped and walked lazily."""
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file
+            return
+        try:
+            if len(buf) < 4:
+                return
+            (magic,) = struct.unpack_from('<I', buf, 0)
+            if magic == PCAPNG_SHB:
+                packets = _pcapngPackets(buf)
+            else:
+                packets = _pcapPackets(buf)
+            for (timestamp, linktype, frame) in packets:
+                datagram = _udpFromFrame(linktype, frame, timestamp)
+                if datagram is None:
+                    continue
+                if port is None or datagram.src[1] == port or datagram.dst[1] == port:
+                    yield datagram
+        finally:
+            buf.close()
+
+
+def readCapture(path, port=coap.COAP_PORT):
+    """Yield a coap.Message for every decodable CoAP datagram in a capture.
+       Message.remote is set to the sender's (address, port) tuple;
+       datagrams that fail to decode are skipped."""
+    for datagram in readDatagrams(path, port):
+        try:
+            msg = coap.Message.decode(datagram.data, remote=datagram.src)
+        except (ValueError, IndexError, struct.error):
+            continue
+        msg.timestamp = datagram.timestamp
+        yield msg
+
+
+REPLAY_SOCKETS = 256
+"""Captured sources given a socket of their own by replayCapture; further
+   sources share these sockets with their Message IDs rewritten."""
+
+
+class _ReplaySocket(object):
+    """A local socket standing in for one or more captured sources."""
+
+    __slots__ = ('sock', 'shared', 'sources', 'mids', 'used', 'next_mid')
+
+    def __init__(self, sock, shared=False):
+        self.sock = sock
+        self.shared = shared
+        self.sources = set()
+        self.mids = collections.OrderedDict()  # (source, captured mid) -> mid sent
+        self.used = set()
+        self.next_mid = 0
+
+    def rewrite(self, source, data):
+        """data with its Message ID made unique among the sources sharing
+           this socket. While a socket has one source its IDs are kept;
+           a captured retransmission keeps the ID its first transmission was
+           given, so the server still sees it as one."""
+        captured = _MID.unpack_from(data, 2)[0]
+        key = (source, captured)
+        mid = self.mids.get(key)
+        if mid is None:
+            if not self.shared and len(self.sources) == 1 and captured not in self.used:
+                mid = captured
+            else:
+                while self.next_mid in self.used:
+                    self.next_mid = (self.next_mid + 1) & 0xFFFF
+                mid = self.next_mid
+                self.next_mid = (self.next_mid + 1) & 0xFFFF
+            self.mids[key] = mid
+            self.used.add(mid)
+            if len(self.mids) > 0x8000:
+                self.used.discard(self.mids.popitem(last=False)[1])
+        if mid == captured:
+            return data
+        data = bytearray(data)
+        _MID.pack_into(data, 2, mid)
+        return data
+
+
+def replayCapture(path, address, speed=1.0, sock=None, port=coap.COAP_PORT, requests_only=True,
+                  max_sockets=REPLAY_SOCKETS):
+    """Re-send captured CoAP datagrams to address.
+
+       Inter-packet gaps from the capture are divided by speed; a speed of
+       None or 0 sends as fast as the socket allows. Only requests are sent
+       unless requests_only is False. Returns the number of datagrams sent.
+
+       Each captured source is replayed from its own socket, up to
+       max_sockets, so the server's (remote, Message ID) deduplication sees
+       the devices as distinct; sources beyond that, or all sources if sock
+       is given, share sockets and have their Message IDs rewritten."""
+    family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+    shared = [_ReplaySocket(sock, shared=True)] if sock is not None else []
+    by_source = {}
+    sent = 0
+    first_capture = None
+    first_wall = None
+    try:
+        for datagram in readDatagrams(path, port):
+            data = datagram.data
+            if len(data) < 4:
+                continue
+            if requests_only and not coap.isRequest(data[1]):
+                continue
+            replay_socket = by_source.get(datagram.src)
+            if replay_socket is None:
+                if not shared and len(by_source) < max_sockets:
+                    replay_socket = _ReplaySocket(socket.socket(family, socket.SOCK_DGRAM))
+                else:
+                    if not shared:
+                        shared = list(by_source.values())
+                    replay_socket = shared[len(by_source) % len(shared)]
+                replay_socket.sources.add(datagram.src)
+                by_source[datagram.src] = replay_socket
+            data = replay_socket.rewrite(datagram.src, data)
+            if speed:
+                if first_capture is None:
+                    first_capture = datagram.timestamp
+                    first_wall = time.time()
+                delay = first_wall + (datagram.timestamp - first_capture) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            replay_socket.sock.sendto(data, address)
+            sent += 1
+    finally:
+        for replay_socket in set(by_source.values()):
+            if replay_socket.sock is not sock:
+                replay_socket.sock.close()
+    return sent
+
+
+def _pcapPackets(buf):
+    """Walk the records of a classic libpcap file."""
+    (magic,) = struct.unpack_from('<I', buf, 0)
+    if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+        endian = '<'
+    else:
+        (magic,) = struct.unpack_from('>I', buf, 0)
+        if magic not in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+            raise ValueError("Not a pcap or pcapng file")
+        endian = '>'
+    resolution = 1e-9 if magic == PCAP_MAGIC_NSEC else 1e-6
+    (linktype,) = struct.unpack_from(endian + 'I', buf, 20)
+    record = struct.Struct(endian + 'IIII')
+    offset = 24
+    end = len(buf)
+    while offset + record.size <= end:
+        (ts_sec, ts_frac, incl_len, _) = record.unpack_from(buf, offset)
+        offset += record.size
+        if offset + incl_len > end:
+            break
+        yield (ts_sec + ts_frac * resolution, linktype & 0x0FFFFFFF, buf[offset:offset + incl_len])
+        offset += incl_len
+
+
+def _pcapngPackets(buf):
+    """Walk the blocks of a pcapng file, following interface descriptions."""
+    end = len(buf)
+    offset = 0
+    endian = '<'
+    interfaces = []
+    while offset + 12 <= end:
+        (block_type,) = struct.unpack_from(endian + 'I', buf, offset)
+        if block_type == PCAPNG_SHB:
+            # Byte order is only known after reading the section header.
+            (bom,) = struct.unpack_from('<I', buf, offset + 8)
+            endian = '<' if bom == PCAPNG_BYTE_ORDER_MAGIC else '>'
+            interfaces = []
+        (block_type, block_len) = struct.unpack_from(endian + 'II', buf, offset)
+        if block_len < 12 or offset + block_len > end:
+            break
+        body = offset + 8
+        if block_type == PCAPNG_IDB:
+            (linktype,) = struct.unpack_from(endian + 'H', buf, body)
+            interfaces.append((linktype, _pcapngResolution(buf, endian, body + 8, offset + block_len - 4)))
+        elif block_type == PCAPNG_EPB:
+            (iface, ts_high, ts_low, cap_len, _) = struct.unpack_from(endian + 'IIIII', buf, body)
+            if iface < len(interfaces):
+                (linktype, resolution) = interfaces[iface]
+                data = body + 20
+                yield (((ts_high << 32) | ts_low) * resolution, linktype, buf[data:data + cap_len])
+        elif block_type == PCAPNG_SPB and interfaces:
+            (orig_len,) = struct.unpack_from(endian + 'I', buf, body)
+            cap_len = min(orig_len, block_len - 16)
+            (linktype, _) = interfaces[0]
+            yield (0.0, linktype, buf[body + 4:body + 4 + cap_len])
+        offset += block_len
+
+
+def _pcapngResolution(buf, endian, offset, end):
+    """Read the if_tsresol option of an interface description block."""
+    while offset + 4 <= end:
+        (code, length) = struct.unpack_from(endian + 'HH', buf, offset)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            (tsresol,) = struct.unpack_from('B', buf, offset + 4)
+            if tsresol & 0x80:
+                return 2.0 ** -(tsresol & 0x7F)
+            return 10.0 ** -tsresol
+        offset += 4 + ((length + 3) & ~3)
+    return 1e-6
+
+
+def _udpFromFrame(linktype, frame, timestamp):
+    """Strip link, network and transport headers from a captured frame.
+       Returns a Datagram, or None if the frame is not a complete UDP packet."""
+    try:
+        if linktype == LINKTYPE_ETHERNET:
+            (ethertype,) = struct.unpack_from('!H', frame, 12)
+            offset = 14
+            while ethertype in ETHERTYPE_VLAN:
+                (ethertype,) = struct.unpack_from('!H', frame, offset + 2)
+                offset += 4
+        elif linktype == LINKTYPE_LINUX_SLL:
+            (ethertype,) = struct.unpack_from('!H', frame, 14)
+            offset = 16
+        elif linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+            # The address family is in host byte order of the capturing machine.
+            (family,) = struct.unpack_from('<I', frame, 0)
+            if family > 0xFFFF:
+                (family,) = struct.unpack_from('>I', frame, 0)
+            ethertype = ETHERTYPE_IPV4 if family == 2 else ETHERTYPE_IPV6
+            offset = 4
+        elif linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+            (first,) = struct.unpack_from('B', frame, 0)
+            ethertype = ETHERTYPE_IPV4 if (first >> 4) == 4 else ETHERTYPE_IPV6
+            offset = 0
+        else:
+            return None
+
+        if ethertype == ETHERTYPE_IPV4:
+            (vihl, _, total_len, _, frag, _, proto) = struct.unpack_from('!BBHHHBB', frame, offset)
+            if proto != IPPROTO_UDP or (frag & 0x3FFF):
+                return None  # not UDP, or a fragment
+            src_ip = socket.inet_ntoa(frame[offset + 12:offset + 16])
+            dst_ip = socket.inet_ntoa(frame[offset + 16:offset + 20])
+            ip_end = offset + total_len
+            offset += (vihl & 0x0F) * 4
+        elif ethertype == ETHERTYPE_IPV6:
+            (payload_len, proto) = struct.unpack_from('!HB', frame, offset + 4)
+            src_ip = socket.inet_ntop(socket.AF_INET6, frame[offset + 8:offset + 24])
+            dst_ip = socket.inet_ntop(socket.AF_INET6, frame[offset + 24:offset + 40])
+            ip_end = offset + 40 + payload_len
+            offset += 40
+            while proto in IPV6_EXTENSION_HEADERS:
+                (proto, ext_len) = struct.unpack_from('!BB', frame, offset)
+                offset += (ext_len + 1) * 8
+            if proto != IPPROTO_UDP:
+                return None
+        else:
+            return None
+
+        (src_port, dst_port, udp_len) = struct.unpack_from('!HHH', frame, offset)
+        start = offset + 8
+        stop = min(offset + udp_len, ip_end)
+        if udp_len < 8 or stop > len(frame):
+            return None  # truncated by snaplen
+        return Datagram(timestamp, (src_ip, src_port), (dst_ip, dst_port), frame[start:stop])
+    except struct.error:
+        return None
@@ -0,0 +1,162 @@
+"""
+Exosite /rpc Proxy Helpers
+
+Utilities for talking to the CBOR-encoded JSON RPC proxy exposed at /rpc,
+see http://docs.exosite.com/rpc for the call and response formats.
+"""
+
+import functools
+import struct
+from itertools import chain
+
+import coap
+import cborstream
+
+
+CONTENT_FORMAT_CBOR = 60
+"""Content-Format number for application/cbor."""
+
+FRAGMENT_CACHE_SIZE = 256
+"""Procedures and aliases whose encoded fragments are kept for reuse."""
+
+
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def _procedurePrefix(procedure):
+    """The encoded start of a call map up to its arguments value."""
+    return (cborstream.encodeHead(5, 3) +
+            cborstream.dumps("procedure") +
+            cborstream.dumps(procedure) +
+            cborstream.dumps("arguments"))
+
+
+class RequestBuilder(object):
+    """Build /rpc request payloads for one CIK from cached CBOR fragments.
+
+       The auth envelope and the fixed part of each call are encoded once;
+       per request only the arguments and call id are encoded and spliced
+       in. The output is byte-for-byte what cbor.dumps produces for
+       {"auth": {"cik": cik}, "calls": [{"procedure": ..., "arguments": ...,
+       "id": ...}, ...]}."""
+
+    def __init__(self, cik):
+        self.cik = cik
+        self._auth_prefix = (cborstream.encodeHead(5, 2) +
+                             cborstream.dumps("auth") +
+                             cborstream.dumps({"cik": cik}) +
+                             cborstream.dumps("calls"))
+
+    def call(self, procedure, arguments, call_id):
+        """Encode a single call; the result can be passed to payload()."""
+        return cborstream.Raw(b''.join((_procedurePrefix(procedure),
+                                        cborstream.dumps(arguments),
+                                        b'\x62id',
+                                        cborstream.dumps(call_id))))
+
+    def payload(self, calls):
+        """Encode a full request from a list of call() results."""
+        return b''.join(chain((self._auth_prefix, cborstream.encodeHead(4, len(calls))), calls))
+
+    def message(self, calls, mid, mtype=coap.CON):
+        """Create a POST /rpc coap.Message carrying calls."""
+        msg = coap.Message(mtype=mtype, mid=mid, code=coap.POST)
+        msg.opt.uri_path = ('rpc', )
+        msg.opt.content_format = CONTENT_FORMAT_CBOR
+        msg.payload = self.payload(calls)
+        return msg
+
+
+@functools.lru_cache(maxsize=FRAGMENT_CACHE_SIZE)
+def aliasArgument(alias):
+    """The pre-encoded {"alias": alias} resource argument."""
+    return cborstream.Raw(cborstream.dumps({"alias": alias}))
+
+
+def decodeResponse(response):
+    """Check the status of a /rpc response Message and return its decoded
+       list of call responses."""
+    if not coap.isSuccessful(response.code):
+        raise ValueError("RPC request failed: {}".format(coap.codes.get(response.code, response.code)))
+    decoder = cborstream.IncrementalDecoder()
+    decoder.feed(response.payload)
+    if not decoder.complete:
+        raise cborstream.CBORDecodeError("Truncated RPC response")
+    return decoder.value
+
+
+def blockwisePayloads(sock, request, address, bufsize=2048, policy=None):
+    """Send request and yield the payload of each Block2 response as it
+       arrives, requesting the next block until the server reports no more.
+       The request message is reused and its Message ID incremented for
+       every follow-up block request. Datagrams that do not answer the
+       outstanding block request (other tokens, stale Message IDs,
+       duplicate blocks) are skipped, and an error response raises
+       ValueError rather than being passed on as CBOR.
+
+       If a coap.BlockSizePolicy is given, the block size it chooses for
+       address is proposed with the first request, and blocks are
+       renegotiated down whenever the policy learns a smaller size."""
+    if policy is not None and request.opt.block2 is None:
+        request.opt.block2 = (0, 0, policy.sizeExponent(address))
+    sock.sendto(request.encode(), address)
+    offset = 0
+    while True:
+        data, addr = sock.recvfrom(bufsize)
+        try:
+            response = coap.Message.decode(data, remote=addr)
+        except (ValueError, IndexError, struct.error):
+            continue
+        if response.mtype == coap.CON:
+            sock.sendto(coap.Message(mtype=coap.ACK, mid=response.mid).encode(), addr)
+        if response.code == coap.EMPTY or response.token != request.token:
+            continue
+        if response.mtype == coap.ACK and response.mid != request.mid:
+            continue
+        block2 = response.opt.block2
+        if block2 is None:
+            if offset:
+                continue
+        elif block2.block_number * 2 ** (block2.size_exponent + 4) != offset:
+            continue
+        if not coap.isSuccessful(response.code):
+            raise ValueError("RPC request failed: {}".format(coap.codes.get(response.code, response.code)))
+        if policy is not None:
+            policy.onResponse(address, response)
+        offset += len(response.payload)
+        yield response.payload
+
+        if block2 is None or not block2.more:
+            return
+
+        number = block2.block_number + 1
+        size_exp = block2.size_exponent
+        if policy is not None and policy.sizeExponent(address) < size_exp:
+            wanted = policy.sizeExponent(address)
+            number *= 2 ** (size_exp - wanted)
+            size_exp = wanted
+        request.mid = (request.mid + 1) & 0xFFFF
+        request.opt.block2 = (number, 0, size_exp)
+        sock.sendto(request.encode(), address)
+
+
+def _isCall(path):
+    return len(path) == 1
+
+
+def _isCallOrDatapoint(path):
+    return len(path) == 1 or (len(path) == 3 and path[1] == 'result' and isinstance(path[2], int))
+
+
+def iterResponse(payloads, datapoints=False):
+    """Incrementally decode an RPC response from an iterable of CBOR chunks.
+
+       Yields (path, value) pairs: ((i,), call_response) as each call's
+       response map completes, and, if datapoints is True, also
+       ((i, 'result', j), datapoint) for each element of a call's result
+       list as soon as it is complete. Streamed datapoints are not kept in
+       the call response, whose 'result' list is then left empty."""
+    decoder = cborstream.IncrementalDecoder(_isCallOrDatapoint if datapoints else _isCall)
+    for payload in payloads:
+        for item in decoder.feed(payload):
+            yield item
+    if not decoder.complete:
+        raise cborstream.CBORDecodeError("RPC response ended before CBOR document was complete")
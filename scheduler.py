@@ -0,0 +1,172 @@
+"""
+COAP Transmit Scheduling
+
+Decides which queued outbound messages may be put on the wire. Messages are
+queued per endpoint in priority classes, confirmable requests are limited to
+NSTART outstanding interactions per endpoint, and traffic to endpoints that
+have stopped responding is paced to PROBING_RATE with a token bucket.
+
+Because a blockwise transfer submits one block per exchange, an URGENT
+message submitted mid-transfer is sent before the next BULK block.
+"""
+
+import heapq
+import itertools
+import time
+
+import coap
+
+
+URGENT = 0
+"""Alarms and other small latency-sensitive messages."""
+
+NORMAL = 1
+"""Ordinary requests."""
+
+BULK = 2
+"""Historical uploads and other large transfers."""
+
+priorities = {0: 'URGENT',
+              1: 'NORMAL',
+              2: 'BULK'}
+
+
+class Transmission(object):
+    """A queued outbound message."""
+
+    __slots__ = ('msg', 'data', 'address', 'priority')
+
+    def __init__(self, msg, data, address, priority):
+        self.msg = msg
+        self.data = data
+        self.address = address
+        self.priority = priority
+
+
+class _Endpoint(object):
+    """Scheduling state for one remote address."""
+
+    __slots__ = ('queue', 'outstanding', 'responsive', 'tokens', 'refilled')
+
+    def __init__(self, now):
+        self.queue = []
+        self.outstanding = 0
+        self.responsive = True
+        self.tokens = 0.0
+        self.refilled = now
+
+
+class TransmitScheduler(object):
+    """Priority- and rate-aware outbound queue.
+
+       submit() queues messages, poll() returns those that may be sent now
+       in priority order, and complete() must be called when a confirmable
+       request's exchange ends so the endpoint's NSTART slot is released.
+       ACK and RST messages are never held back."""
+
+    def __init__(self, nstart=coap.NSTART, probing_rate=coap.PROBING_RATE, clock=time.time):
+        self.nstart = nstart
+        self.probing_rate = probing_rate
+        self.clock = clock
+        self._endpoints = {}
+        self._seq = itertools.count()
+
+    def _endpoint(self, address):
+        endpoint = self._endpoints.get(address)
+        if endpoint is None:
+            endpoint = self._endpoints[address] = _Endpoint(self.clock())
+        return endpoint
+
+    def submit(self, msg, address, priority=NORMAL):
+        """Queue msg for address; it is encoded immediately."""
+        item = Transmission(msg, msg.encode(), address, priority)
+        # Acknowledgements jump every queue so they are never stuck behind a
+        # request waiting for an NSTART slot.
+        rank = -1 if msg.mtype in (coap.ACK, coap.RST) else priority
+        heapq.heappush(self._endpoint(address).queue, (rank, next(self._seq), item))
+        return item
+
+    def pending(self):
+        """Number of queued messages."""
+        return sum(len(endpoint.queue) for endpoint in self._endpoints.values())
+
+    def poll(self):
+        """Dequeue and return, highest priority first, every Transmission
+           that may be sent now."""
+        now = self.clock()
+        heads = []
+        for endpoint in self._endpoints.values():
+            if endpoint.queue:
+                heapq.heappush(heads, (endpoint.queue[0][:2], endpoint))
+        ready = []
+        while heads:
+            (_, endpoint) = heapq.heappop(heads)
+            item = endpoint.queue[0][2]
+            if not self._admit(endpoint, item, now):
+                continue
+            heapq.heappop(endpoint.queue)
+            ready.append(item)
+            if endpoint.queue:
+                heapq.heappush(heads, (endpoint.queue[0][:2], endpoint))
+        return ready
+
+    def _admit(self, endpoint, item, now):
+        """Whether item may be sent now; charges NSTART slot and tokens."""
+        msg = item.msg
+        if msg.mtype in (coap.ACK, coap.RST):
+            return True
+        if msg.mtype == coap.CON and coap.isRequest(msg.code) and endpoint.outstanding >= self.nstart:
+            return False
+        if not endpoint.responsive:
+            self._refill(endpoint, now)
+            if endpoint.tokens < 0:
+                return False
+            # Allow one message into debt so a message larger than a single
+            # second's budget is not blocked forever.
+            endpoint.tokens -= len(item.data)
+        if msg.mtype == coap.CON and coap.isRequest(msg.code):
+            endpoint.outstanding += 1
+        return True
+
+    def _refill(self, endpoint, now):
+        endpoint.tokens = min(endpoint.tokens + (now - endpoint.refilled) * self.probing_rate, 0.0)
+        endpoint.refilled = now
+
+    def complete(self, address, responded=True):
+        """End one outstanding confirmable exchange with address.
+           responded=False (the exchange timed out) marks the endpoint
+           unresponsive, after which it is paced to the probing rate
+           until it answers again."""
+        endpoint = self._endpoint(address)
+        if endpoint.outstanding > 0:
+            endpoint.outstanding -= 1
+        self.setResponsive(address, responded)
+
+    def setResponsive(self, address, responsive):
+        """Record whether address is currently answering, e.g. after a
+           response to a NON request."""
+        endpoint = self._endpoint(address)
+        if responsive == endpoint.responsive:
+            return
+        endpoint.responsive = responsive
+        endpoint.tokens = 0.0
+        endpoint.refilled = self.clock()
+
+    def timeout(self):
+        """Seconds until a paced message could become sendable, 0 if one is
+           sendable now, or None if nothing is waiting on pacing."""
+        now = self.clock()
+        best = None
+        for endpoint in self._endpoints.values():
+            if not endpoint.queue:
+                continue
+            item = endpoint.queue[0][2]
+            blocked = (item.msg.mtype == coap.CON and coap.isRequest(item.msg.code) and
+                       endpoint.outstanding >= self.nstart)
+            if blocked:
+                continue
+            if endpoint.responsive or item.msg.mtype in (coap.ACK, coap.RST):
+                return 0
+            wait = max(0.0, -(endpoint.tokens + (now - endpoint.refilled) * self.probing_rate) / self.probing_rate)
+            best = wait if best is None else min(best, wait)
+        return best
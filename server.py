@@ -0,0 +1,330 @@
+"""
+COAP Resource Server
+
+A small server layer on top of Message.decode. Resources are registered in
+a trie keyed by Uri-Path segment, so dispatching a request costs one dict
+lookup per path segment regardless of how many resources exist.
+
+Resources implement render_GET/render_POST/render_PUT/render_DELETE (named
+after the coap.requests table). A render method returns either a response
+Message, sent piggybacked on the ACK, or a concurrent.futures.Future; a
+Future that is not done within EMPTY_ACK_DELAY gets an empty ACK and its
+result is later sent as a separate confirmable response. An exception or
+any other return value is answered 5.00 Internal Server Error. Responses
+larger than the negotiated block size are served blockwise with
+extractBlock.
+
+Requests carrying Proxy-Uri or Proxy-Scheme go to the server's proxy
+resource instead, see the proxy module.
+"""
+
+import collections
+import random
+import select
+import socket
+import struct
+import time
+from concurrent.futures import Future
+
+import coap
+
+
+class Resource(object):
+    """A CoAP resource. Subclasses add render_<METHOD> methods."""
+
+    isLeaf = False
+    """If True, requests for paths below this resource are also routed to
+       it, with the extra segments in request.postpath."""
+
+    def render(self, request):
+        handler = getattr(self, 'render_' + coap.requests.get(request.code, ''), None)
+        if handler is None:
+            return coap.Message(code=coap.METHOD_NOT_ALLOWED)
+        return handler(request)
+
+
+class _Node(object):
+    __slots__ = ('children', 'resource')
+
+    def __init__(self):
+        self.children = {}
+        self.resource = None
+
+
+class ResourceTree(object):
+    """Maps Uri-Path segment sequences to resources."""
+
+    def __init__(self):
+        self._root = _Node()
+
+    def putChild(self, path, resource):
+        """Register resource at path, a list or tuple of segments."""
+        if isinstance(path, (str, bytes)):
+            raise ValueError("Path should be passed as a list or tuple of segments")
+        node = self._root
+        for segment in path:
+            if isinstance(segment, str):
+                segment = segment.encode('utf-8')
+            node = node.children.setdefault(segment, _Node())
+        node.resource = resource
+
+    def resolve(self, segments):
+        """Return (resource, depth) for the deepest resource matching
+           segments exactly, or as a prefix if it is a leaf; resource is
+           None if nothing matches."""
+        node = self._root
+        match = (node.resource, 0) if node.resource is not None and node.resource.isLeaf else (None, 0)
+        for depth, segment in enumerate(segments, 1):
+            node = node.children.get(segment)
+            if node is None:
+                return match
+            if node.resource is not None and node.resource.isLeaf:
+                match = (node.resource, depth)
+        if node.resource is not None:
+            return (node.resource, len(segments))
+        return match
+
+
+class _Deferred(object):
+    """A request whose response is a Future."""
+
+    __slots__ = ('request', 'future', 'deadline', 'acked')
+
+    def __init__(self, request, future, deadline):
+        self.request = request
+        self.future = future
+        self.deadline = deadline
+        self.acked = False
+
+
+class Server(object):
+    """Serves a ResourceTree over a UDP socket.
+
+       serveForever() runs the receive loop; poll() runs a single
+       iteration for embedding in another loop."""
+
+    def __init__(self, tree, sock=None, address=('', coap.COAP_PORT), block_policy=None, proxy=None):
+        self.tree = tree
+        self.proxy = proxy
+        """Resource that renders requests carrying Proxy-Uri or Proxy-Scheme;
+           without one they are answered 5.05 Proxying Not Supported."""
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(address)
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.block_policy = block_policy
+        self.rejected = 0
+        """Datagrams dropped as malformed."""
+        self._mid = random.randint(0, 0xFFFF)
+        self._recent = collections.OrderedDict()  # (remote, mid) -> (encoded response, expiry)
+        self._deferred = []
+        self._retransmit = {}  # mid -> [data, remote, deadline, timeout, attempts]
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._running = False
+
+    def _nextMid(self):
+        self._mid = (self._mid + 1) & 0xFFFF
+        return self._mid
+
+    def serveForever(self):
+        self._running = True
+        while self._running:
+            self.poll()
+
+    def stop(self):
+        self._running = False
+        self._wakeup_w.send(b'\0')
+
+    def poll(self, timeout=None):
+        """Wait up to timeout (or until the next timer) for datagrams and
+           handle them and any due timers."""
+        wait = self._nextTimer()
+        if timeout is not None:
+            wait = timeout if wait is None else min(wait, timeout)
+        readable, _, _ = select.select([self.sock, self._wakeup_r], [], [], wait)
+        if self._wakeup_r in readable:
+            try:
+                while self._wakeup_r.recv(64):
+                    pass
+            except (BlockingIOError, socket.error):
+                pass
+        if self.sock in readable:
+            while True:
+                try:
+                    data, remote = self.sock.recvfrom(65535)
+                except (BlockingIOError, socket.error):
+                    break
+                self.datagramReceived(data, remote)
+        self._runTimers()
+
+    def datagramReceived(self, data, remote):
+        # Shed malformed traffic before anything is allocated for it.
+        if coap.validate(data) != coap.DATAGRAM_OK:
+            self.rejected += 1
+            return
+        try:
+            request = coap.Message.decode(data, remote=remote)
+        except (ValueError, IndexError, struct.error):
+            self.rejected += 1
+            return
+        if request.mtype in (coap.ACK, coap.RST):
+            self._retransmit.pop(request.mid, None)
+            return
+        if not coap.isRequest(request.code):
+            if request.mtype == coap.CON:
+                self._send(coap.Message(mtype=coap.RST, mid=request.mid), remote)
+            return
+
+        key = (remote, request.mid)
+        cached = self._recent.get(key)
+        if cached is not None:
+            if cached[0] is not None:
+                self._sendto(cached[0], remote)
+            return
+        self._recent[key] = (None, time.time() + coap.EXCHANGE_LIFETIME)
+
+        if request.opt.proxy_uri is not None or request.opt.proxy_scheme is not None:
+            if self.proxy is None:
+                self._respond(request, coap.Message(code=coap.PROXYING_NOT_SUPPORTED))
+                return
+            resource = self.proxy
+        else:
+            segments = request.opt.uri_path
+            (resource, depth) = self.tree.resolve(segments)
+            if resource is None:
+                self._respond(request, coap.Message(code=coap.NOT_FOUND))
+                return
+            request.prepath = segments[:depth]
+            request.postpath = segments[depth:]
+        try:
+            result = resource.render(request)
+        except Exception:
+            result = coap.Message(code=coap.INTERNAL_SERVER_ERROR)
+
+        if isinstance(result, coap.Message):
+            self._respond(request, result)
+            return
+        if not isinstance(result, Future):
+            self._respond(request, coap.Message(code=coap.INTERNAL_SERVER_ERROR))
+            return
+        deferred = _Deferred(request, result, time.time() + coap.EMPTY_ACK_DELAY)
+        self._deferred.append(deferred)
+        result.add_done_callback(lambda future: self._wakeup_w.send(b'\0'))
+
+    def _respond(self, request, response, separate=False):
+        """Complete response for request and send it."""
+        response.token = request.token
+        if separate:
+            response.mtype = coap.CON if request.mtype == coap.CON else coap.NON
+            response.mid = self._nextMid()
+        elif request.mtype == coap.CON:
+            response.mtype = coap.ACK
+            response.mid = request.mid
+        else:
+            response.mtype = coap.NON
+            response.mid = self._nextMid()
+        while True:
+            block = self._selectBlock(request, response)
+            data = block.encode()
+            size_exp = self.block_policy.sizeExponent(request.remote) if self.block_policy is not None else None
+            if self._sendto(data, request.remote) or size_exp is None:
+                break
+            if self.block_policy.sizeExponent(request.remote) == size_exp:
+                break  # the policy could not shrink the block any further
+        if not separate:
+            self._recent[(request.remote, request.mid)] = (data, time.time() + coap.EXCHANGE_LIFETIME)
+        elif response.mtype == coap.CON:
+            timeout = coap.ACK_TIMEOUT * random.uniform(1, coap.ACK_RANDOM_FACTOR)
+            self._retransmit[response.mid] = [data, request.remote, time.time() + timeout, timeout, 0]
+
+    def _selectBlock(self, request, response):
+        """Cut the block the client asked for out of a large response."""
+        size_exp = coap.DEFAULT_BLOCK_SIZE_EXP
+        if self.block_policy is not None:
+            size_exp = self.block_policy.sizeExponent(request.remote)
+        number = 0
+        block2 = request.opt.block2
+        if block2 is not None:
+            if block2.size_exponent <= size_exp:
+                size_exp = block2.size_exponent
+                number = block2.block_number
+            else:
+                # Answer with smaller blocks than asked for, starting at
+                # the same byte offset.
+                number = block2.block_number * 2 ** (block2.size_exponent - size_exp)
+        if number == 0 and len(response.payload) <= 2 ** (size_exp + 4):
+            return response
+        mid = response.mid
+        block = response.extractBlock(number, size_exp)
+        if block is None:
+            return coap.Message(mtype=response.mtype, mid=mid, code=coap.BAD_OPTION, token=response.token)
+        block.mid = mid
+        return block
+
+    def _send(self, msg, remote):
+        data = msg.encode()
+        self._sendto(data, remote)
+        return data
+
+    def _sendto(self, data, remote):
+        """Send a datagram, returning False if the socket refused it. The
+           block size policy learns from the error; otherwise the datagram
+           is treated as lost."""
+        try:
+            self.sock.sendto(data, remote)
+        except socket.error as e:
+            if self.block_policy is not None:
+                self.block_policy.onSendError(remote, e)
+            return False
+        return True
+
+    def _nextTimer(self):
+        deadlines = [d.deadline for d in self._deferred if not d.acked]
+        deadlines.extend(entry[2] for entry in self._retransmit.values())
+        if self._recent:
+            deadlines.append(next(iter(self._recent.values()))[1])
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.time())
+
+    def _runTimers(self):
+        now = time.time()
+        still_waiting = []
+        for deferred in self._deferred:
+            request = deferred.request
+            if deferred.future.done():
+                try:
+                    response = deferred.future.result()
+                except Exception:
+                    response = coap.Message(code=coap.INTERNAL_SERVER_ERROR)
+                if not isinstance(response, coap.Message):
+                    response = coap.Message(code=coap.INTERNAL_SERVER_ERROR)
+                self._respond(request, response, separate=deferred.acked)
+                continue
+            if not deferred.acked and now >= deferred.deadline:
+                deferred.acked = True
+                if request.mtype == coap.CON:
+                    data = self._send(coap.Message(mtype=coap.ACK, mid=request.mid), request.remote)
+                    self._recent[(request.remote, request.mid)] = (data, now + coap.EXCHANGE_LIFETIME)
+            still_waiting.append(deferred)
+        self._deferred = still_waiting
+
+        for mid, entry in list(self._retransmit.items()):
+            (data, remote, deadline, timeout, attempts) = entry
+            if now < deadline:
+                continue
+            if attempts >= coap.MAX_RETRANSMIT:
+                del self._retransmit[mid]
+                continue
+            entry[3] = timeout * 2
+            entry[2] = now + entry[3]
+            entry[4] = attempts + 1
+            self._sendto(data, remote)
+
+        while self._recent:
+            key, (data, expiry) = next(iter(self._recent.items()))
+            if expiry > now:
+                break
+            del self._recent[key]
@@ -0,0 +1,373 @@
+"""
+COAP Network Simulator
+
+An in-process discrete-event simulator for benchmarking protocol-layer
+settings without real sockets or real timeouts. Simulated devices and a
+simulated server exchange coap.Message encoded datagrams over links with
+configurable delay, jitter, loss and duplication; all timing runs on a
+virtual clock, so hours of traffic take only as long as the events take to
+process.
+
+    report = simulator.simulate(devices=10000, duration=3600.0,
+                                link=simulator.Link(loss=0.05))
+    print(report)
+"""
+
+import heapq
+import itertools
+import random
+import struct
+import time
+
+import coap
+
+
+class Simulator(object):
+    """A virtual clock and the queue of events scheduled on it."""
+
+    def __init__(self, seed=None):
+        self.now = 0.0
+        self.random = random.Random(seed)
+        self._queue = []
+        self._seq = itertools.count()
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) delay virtual seconds from now."""
+        heapq.heappush(self._queue, (self.now + delay, next(self._seq), callback, args))
+
+    def run(self, until=None):
+        """Process events in time order until none are left or the clock
+           would pass until. Returns the number of events processed."""
+        processed = 0
+        queue = self._queue
+        while queue:
+            if until is not None and queue[0][0] > until:
+                self.now = until
+                break
+            (self.now, _, callback, args) = heapq.heappop(queue)
+            callback(*args)
+            processed += 1
+        return processed
+
+
+class Link(object):
+    """One-way path characteristics. Each datagram is lost with probability
+       loss, otherwise delivered after delay plus a uniform random jitter
+       (so jitter larger than the gap between datagrams reorders them), and
+       delivered a second time with probability duplicate."""
+
+    def __init__(self, delay=0.05, jitter=0.0, loss=0.0, duplicate=0.0):
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.duplicate = duplicate
+
+    def transit(self, rng):
+        """Delays after which copies of a datagram arrive; empty if lost."""
+        if rng.random() < self.loss:
+            return ()
+        first = self.delay + rng.random() * self.jitter
+        if self.duplicate and rng.random() < self.duplicate:
+            return (first, self.delay + rng.random() * self.jitter)
+        return (first, )
+
+
+class Network(object):
+    """Connects endpoints, each an object with a datagramReceived(data,
+       remote) method, by address."""
+
+    def __init__(self, sim, link=None):
+        self.sim = sim
+        self.default_link = link if link is not None else Link()
+        self.sent = 0
+        self.lost = 0
+        self._endpoints = {}
+        self._links = {}
+
+    def attach(self, address, endpoint):
+        self._endpoints[address] = endpoint
+
+    def setLink(self, src, dst, link):
+        """Use link for datagrams from src to dst."""
+        self._links[(src, dst)] = link
+
+    def send(self, src, dst, data):
+        self.sent += 1
+        link = self._links.get((src, dst), self.default_link) if self._links else self.default_link
+        delays = link.transit(self.sim.random)
+        if not delays:
+            self.lost += 1
+            return
+        endpoint = self._endpoints.get(dst)
+        if endpoint is None:
+            return
+        for delay in delays:
+            self.sim.schedule(delay, endpoint.datagramReceived, data, src)
+
+
+class ProtocolConfig(object):
+    """The protocol-layer settings a simulated device uses."""
+
+    def __init__(self, mtype=coap.CON, ack_timeout=coap.ACK_TIMEOUT, ack_random_factor=coap.ACK_RANDOM_FACTOR,
+                 max_retransmit=coap.MAX_RETRANSMIT, nstart=coap.NSTART, block_size_exp=coap.DEFAULT_BLOCK_SIZE_EXP,
+                 non_timeout=coap.MAX_TRANSMIT_WAIT):
+        self.mtype = mtype
+        self.ack_timeout = ack_timeout
+        self.ack_random_factor = ack_random_factor
+        self.max_retransmit = max_retransmit
+        self.nstart = nstart
+        self.block_size_exp = block_size_exp
+        self.non_timeout = non_timeout
+        """Time after which a NON request without response counts as failed."""
+
+    def __repr__(self):
+        return "ProtocolConfig(mtype={}, ack_timeout={}, max_retransmit={}, nstart={}, block_size_exp={})".format(
+            coap.types[self.mtype], self.ack_timeout, self.max_retransmit, self.nstart, self.block_size_exp)
+
+
+class Report(object):
+    """Outcome counters and latencies collected during a run."""
+
+    def __init__(self):
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.transmissions = 0
+        self.retransmissions = 0
+        self.latencies = []
+        self.duration = 0.0
+        self.events = 0
+        self.wall_time = 0.0
+        self.datagrams = 0
+        self.datagrams_lost = 0
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def summary(self):
+        return {'started': self.started,
+                'completed': self.completed,
+                'failed': self.failed,
+                'throughput': self.completed / self.duration if self.duration else 0.0,
+                'latency_p50': self.percentile(0.50),
+                'latency_p90': self.percentile(0.90),
+                'latency_p99': self.percentile(0.99),
+                'latency_max': max(self.latencies) if self.latencies else None,
+                'transmissions': self.transmissions,
+                'retransmissions': self.retransmissions,
+                'datagrams': self.datagrams,
+                'datagrams_lost': self.datagrams_lost,
+                'events': self.events,
+                'wall_time': self.wall_time}
+
+    def __str__(self):
+        s = self.summary()
+
+        def ms(value):
+            return "-" if value is None else "{:.1f} ms".format(value * 1000)
+        return ("Exchanges:     {} started, {} completed, {} failed\n"
+                "Throughput:    {:.2f} exchanges/s over {:.0f} s\n"
+                "Latency:       p50 {}, p90 {}, p99 {}, max {}\n"
+                "Datagrams:     {} sent, {} lost, {} retransmissions\n"
+                "Simulation:    {} events in {:.2f} s wall time").format(
+                    s['started'], s['completed'], s['failed'],
+                    s['throughput'], self.duration,
+                    ms(s['latency_p50']), ms(s['latency_p90']), ms(s['latency_p99']), ms(s['latency_max']),
+                    s['datagrams'], s['datagrams_lost'], s['retransmissions'],
+                    s['events'], s['wall_time'])
+
+
+class SimServer(object):
+    """Answers every request with a response_size byte representation,
+       piggybacked for CON and as NON for NON, blockwise when it does not
+       fit the negotiated block size."""
+
+    def __init__(self, network, address, response_size=32, processing_delay=0.0,
+                 block_size_exp=coap.DEFAULT_BLOCK_SIZE_EXP):
+        self.network = network
+        self.address = address
+        self.processing_delay = processing_delay
+        self.block_size_exp = block_size_exp
+        self.requests = 0
+        self._representation = coap.Message(code=coap.CONTENT, payload=b'\x00' * response_size)
+        self._mid = 0
+        network.attach(address, self)
+
+    def datagramReceived(self, data, remote):
+        try:
+            request = coap.Message.decode(data, remote=remote)
+        except (ValueError, IndexError, struct.error):
+            return
+        if not coap.isRequest(request.code):
+            return
+        self.requests += 1
+        size_exp = self.block_size_exp
+        number = 0
+        if request.opt.block2 is not None:
+            size_exp = min(size_exp, request.opt.block2.size_exponent)
+            number = request.opt.block2.block_number
+        if number == 0 and len(self._representation.payload) <= 2 ** (size_exp + 4):
+            response = self._representation.clone()
+        else:
+            response = self._representation.extractBlock(number, size_exp)
+            if response is None:
+                response = coap.Message(code=coap.BAD_OPTION)
+        response.token = request.token
+        if request.mtype == coap.CON:
+            response.mtype = coap.ACK
+            response.mid = request.mid
+        else:
+            self._mid = (self._mid + 1) & 0xFFFF
+            response.mtype = coap.NON
+            response.mid = self._mid
+        data = response.encode()
+        if self.processing_delay:
+            self.network.sim.schedule(self.processing_delay, self.network.send, self.address, remote, data)
+        else:
+            self.network.send(self.address, remote, data)
+
+
+class _SimExchange(object):
+    __slots__ = ('token', 'started', 'block', 'mid', 'attempt', 'done')
+
+    def __init__(self, token, started):
+        self.token = token
+        self.started = started
+        self.block = 0
+        self.mid = None
+        self.attempt = 0
+        self.done = False
+
+
+class SimDevice(object):
+    """Issues a GET to the server every interval seconds, following Block2
+       responses, with retransmission and NSTART as set in config."""
+
+    def __init__(self, network, address, server_address, config, report, interval=60.0, path=('1a', 'alias')):
+        self.network = network
+        self.address = address
+        self.server_address = server_address
+        self.config = config
+        self.report = report
+        self.interval = interval
+        self.path = path
+        self._mid = 0
+        self._tokens = itertools.count()
+        self._queued = 0
+        self._outstanding = 0
+        self._exchanges = {}
+        network.attach(address, self)
+
+    def start(self, at):
+        self.network.sim.schedule(at, self._tick)
+
+    def _tick(self):
+        self._queued += 1
+        self._pump()
+        self.network.sim.schedule(self.interval, self._tick)
+
+    def _pump(self):
+        while self._queued and self._outstanding < self.config.nstart:
+            self._queued -= 1
+            self._outstanding += 1
+            self.report.started += 1
+            exchange = _SimExchange(struct.pack('!I', next(self._tokens) & 0xFFFFFFFF), self.network.sim.now)
+            self._exchanges[exchange.token] = exchange
+            self._transmit(exchange)
+
+    def _transmit(self, exchange):
+        config = self.config
+        self._mid = (self._mid + 1) & 0xFFFF
+        exchange.mid = self._mid
+        exchange.attempt = 0
+        msg = coap.Message(mtype=config.mtype, mid=self._mid, code=coap.GET, token=exchange.token)
+        msg.opt.uri_path = self.path
+        if exchange.block or config.block_size_exp < coap.DEFAULT_BLOCK_SIZE_EXP:
+            msg.opt.block2 = (exchange.block, 0, config.block_size_exp)
+        data = msg.encode()
+        self._send(data)
+        if config.mtype == coap.CON:
+            timeout = config.ack_timeout * self.network.sim.random.uniform(1, config.ack_random_factor)
+            self.network.sim.schedule(timeout, self._timeout, exchange, exchange.mid, 0, timeout, data)
+        else:
+            self.network.sim.schedule(config.non_timeout, self._timeout, exchange, exchange.mid, 0, 0, data)
+
+    def _send(self, data):
+        self.report.transmissions += 1
+        self.network.send(self.address, self.server_address, data)
+
+    def _timeout(self, exchange, mid, attempt, timeout, data):
+        if exchange.done or exchange.mid != mid or exchange.attempt != attempt:
+            return
+        if self.config.mtype != coap.CON or attempt >= self.config.max_retransmit:
+            self._finish(exchange, False)
+            return
+        exchange.attempt = attempt + 1
+        self.report.retransmissions += 1
+        self._send(data)
+        self.network.sim.schedule(timeout * 2, self._timeout, exchange, mid, attempt + 1, timeout * 2, data)
+
+    def datagramReceived(self, data, remote):
+        try:
+            response = coap.Message.decode(data, remote=remote)
+        except (ValueError, IndexError, struct.error):
+            return
+        if response.mtype == coap.CON:
+            self.network.send(self.address, remote, coap.Message(mtype=coap.ACK, mid=response.mid).encode())
+        exchange = self._exchanges.get(response.token)
+        if exchange is None or exchange.done:
+            return
+        block2 = response.opt.block2
+        if block2 is not None:
+            if block2.block_number != exchange.block:
+                return  # duplicate or reordered block
+            if block2.more:
+                exchange.block += 1
+                self._transmit(exchange)
+                return
+        self._finish(exchange, coap.isSuccessful(response.code))
+
+    def _finish(self, exchange, success):
+        exchange.done = True
+        del self._exchanges[exchange.token]
+        if success:
+            self.report.completed += 1
+            self.report.latencies.append(self.network.sim.now - exchange.started)
+        else:
+            self.report.failed += 1
+        self._outstanding -= 1
+        self._pump()
+
+
+def simulate(devices=1000, duration=3600.0, config=None, link=None, interval=60.0,
+             response_size=32, processing_delay=0.0, seed=0):
+    """Run devices polling one server for duration virtual seconds and
+       return a Report. Devices start at random phases within the first
+       interval."""
+    started = time.time()
+    sim = Simulator(seed)
+    network = Network(sim, link)
+    config = config if config is not None else ProtocolConfig()
+    report = Report()
+    server_address = ('server', coap.COAP_PORT)
+    SimServer(network, server_address, response_size, processing_delay)
+    for index in range(devices):
+        device = SimDevice(network, ('device', index), server_address, config, report, interval)
+        device.start(sim.random.random() * interval)
+    report.events = sim.run(until=duration)
+    report.duration = duration
+    report.datagrams = network.sent
+    report.datagrams_lost = network.lost
+    report.wall_time = time.time() - started
+    return report
+
+
+if __name__ == '__main__':
+    lossy = Link(delay=0.05, jitter=0.02, loss=0.05)
+    for config in (ProtocolConfig(), ProtocolConfig(block_size_exp=4), ProtocolConfig(mtype=coap.NON)):
+        print(config)
+        print(simulate(devices=1000, duration=600.0, config=config, link=lossy, response_size=2048))
+        print("")
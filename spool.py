@@ -0,0 +1,404 @@
+"""
+Durable Outbound Write Spool
+
+Queues outbound datapoint writes on disk while the uplink is down and drains
+them as batched /rpc record calls once it is back. Records are appended to
+fixed-size, memory-mapped segment files; a small cursor file records how far
+the server has acknowledged. Both survive restarts, and the number of
+segments is capped so a long outage overwrites the oldest data rather than
+filling the disk or memory.
+"""
+
+import mmap
+import os
+import random
+import socket
+import struct
+import time
+import zlib
+
+import coap
+import cborstream
+import rpc
+
+
+SEGMENT_SIZE = 1 << 20
+"""Size in bytes of each segment file."""
+
+MAX_SEGMENTS = 64
+"""Segments kept before the oldest is discarded."""
+
+MAX_BATCH_PAYLOAD = 1024
+"""Upper bound for the CBOR payload of one drained batch, chosen so a batch
+   fits a single datagram without blockwise transfer."""
+
+_RECORD_HEADER = struct.Struct('!II')  # length, crc32
+_CURSOR = struct.Struct('!QI')  # segment sequence number, offset
+_SEGMENT_SUFFIX = '.seg'
+_CALL_OVERHEAD = 40  # approximate bytes per record call besides its points
+
+
+class Spool(object):
+    """An append-only, segmented on-disk queue of (alias, timestamp, value)
+       records.
+
+       Records are read with read() and only removed by commit(), so a
+       batch that was not acknowledged is read again after a restart."""
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, max_segments=MAX_SEGMENTS, sync=False):
+        if max_segments < 2:
+            raise ValueError("Spool needs at least two segments")
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.sync = sync
+        self.dropped_segments = 0
+        """Segments discarded unread because the spool was full."""
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._segments = sorted(int(name[:-len(_SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                                if name.endswith(_SEGMENT_SUFFIX))
+        self._cursor = self._loadCursor()
+        self._write_file = None
+        self._write_map = None
+        if self._segments:
+            self._openWriteSegment(self._segments[-1])
+        else:
+            self._rollSegment()
+
+    def close(self):
+        """Flush and unmap the active segment."""
+        if self._write_map is not None:
+            self._write_map.flush()
+            self._write_map.close()
+            self._write_file.close()
+            self._write_map = None
+            self._write_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, alias, value, timestamp=None):
+        """Queue a datapoint for alias. timestamp defaults to now."""
+        if timestamp is None:
+            timestamp = int(time.time())
+        data = cborstream.dumps([alias, timestamp, value])
+        needed = _RECORD_HEADER.size + len(data)
+        if needed > self.segment_size - _RECORD_HEADER.size:
+            raise ValueError("Record of {} bytes does not fit in a segment".format(len(data)))
+        # Always leave room for a zero header so readers find the end.
+        if self._write_offset + needed > self.segment_size - _RECORD_HEADER.size:
+            self._rollSegment()
+        offset = self._write_offset
+        self._write_map[offset + _RECORD_HEADER.size:offset + needed] = data
+        # The header goes in last so a torn write never looks like a record.
+        _RECORD_HEADER.pack_into(self._write_map, offset, len(data), zlib.crc32(data) & 0xFFFFFFFF)
+        self._write_offset = offset + needed
+        if self.sync:
+            self._write_map.flush()
+
+    def flush(self):
+        """Write the active segment back to disk."""
+        self._write_map.flush()
+
+    def _empty(self):
+        return not self.read(1)[0]
+    empty = property(_empty)
+
+    def read(self, max_records=None):
+        """Return (records, position) for up to max_records pending
+           records, oldest first. Pass position to commit() once they have
+           been delivered."""
+        records = []
+        (seq, offset) = self._cursor
+        while True:
+            if seq == self._write_seq:
+                offset = _readRecords(self._write_map, offset, records, max_records)
+                break
+            buf = self._mapSegment(seq)
+            try:
+                offset = _readRecords(buf, offset, records, max_records)
+            finally:
+                buf.close()
+            if max_records is not None and len(records) >= max_records:
+                break
+            later = [s for s in self._segments if s > seq]
+            if not later:
+                break
+            (seq, offset) = (later[0], 0)
+        return (records, (seq, offset))
+
+    def commit(self, position):
+        """Mark everything before position as delivered and delete fully
+           delivered segments."""
+        (seq, offset) = position
+        if seq < self._cursor[0] or (seq == self._cursor[0] and offset <= self._cursor[1]):
+            return
+        self._cursor = (seq, offset)
+        self._saveCursor()
+        for old in [s for s in self._segments if s < seq]:
+            self._removeSegment(old)
+
+    def _segmentPath(self, seq):
+        return os.path.join(self.directory, '{:016d}{}'.format(seq, _SEGMENT_SUFFIX))
+
+    def _mapSegment(self, seq):
+        with open(self._segmentPath(seq), 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _openWriteSegment(self, seq):
+        self.close()
+        path = self._segmentPath(seq)
+        f = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        f.truncate(self.segment_size)
+        self._write_file = f
+        self._write_map = mmap.mmap(f.fileno(), self.segment_size)
+        self._write_seq = seq
+        # Find the end of the valid records and clear anything after it, such
+        # as a record torn by a crash, so it can never be read back.
+        offset = 0
+        while True:
+            (record, next_offset) = _readRecord(self._write_map, offset)
+            if record is None:
+                break
+            offset = next_offset
+        self._write_map[offset:] = bytes(self.segment_size - offset)
+        self._write_offset = offset
+
+    def _rollSegment(self):
+        seq = self._segments[-1] + 1 if self._segments else 0
+        self._segments.append(seq)
+        self._openWriteSegment(seq)
+        while len(self._segments) > self.max_segments:
+            oldest = self._segments[0]
+            if self._cursor[0] <= oldest:
+                self._cursor = (self._segments[1], 0)
+                self._saveCursor()
+                self.dropped_segments += 1
+            self._removeSegment(oldest)
+
+    def _removeSegment(self, seq):
+        self._segments.remove(seq)
+        try:
+            os.remove(self._segmentPath(seq))
+        except OSError:
+            pass
+
+    def _loadCursor(self):
+        default = (self._segments[0] if self._segments else 0, 0)
+        try:
+            with open(os.path.join(self.directory, 'cursor'), 'rb') as f:
+                (seq, offset) = _CURSOR.unpack(f.read(_CURSOR.size))
+        except (IOError, OSError, struct.error):
+            return default
+        if self._segments and seq < self._segments[0]:
+            return default
+        return (seq, offset)
+
+    def _saveCursor(self):
+        path = os.path.join(self.directory, 'cursor')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(_CURSOR.pack(*self._cursor))
+            if self.sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+
+def _readRecords(buf, offset, records, max_records):
+    """Append records from buf starting at offset; return the offset
+       following the last one read."""
+    while max_records is None or len(records) < max_records:
+        (record, next_offset) = _readRecord(buf, offset)
+        if record is None:
+            break
+        records.append(record)
+        offset = next_offset
+    return offset
+
+
+def _readRecord(buf, offset):
+    """Return ((alias, timestamp, value), next_offset), or (None, offset) at
+       the end of the segment's valid records."""
+    if offset + _RECORD_HEADER.size > len(buf):
+        return (None, offset)
+    (length, crc) = _RECORD_HEADER.unpack_from(buf, offset)
+    start = offset + _RECORD_HEADER.size
+    if length == 0 or start + length > len(buf):
+        return (None, offset)
+    data = buf[start:start + length]
+    if zlib.crc32(data) & 0xFFFFFFFF != crc:
+        return (None, offset)
+    decoder = cborstream.IncrementalDecoder()
+    decoder.feed(data)
+    return (tuple(decoder.value), start + length)
+
+
+AUTH_FAILURE_STATUSES = frozenset(['noauth', 'restricted'])
+"""Per-call /rpc statuses meaning the CIK itself was refused."""
+
+
+class SpoolDrainer(object):
+    """Drains a Spool to Exosite as /rpc record batches.
+
+       Batches are sent stop-and-wait: the next batch is only read once
+       the previous one is acknowledged, and draining stops at the first
+       batch that times out, so the spool advances no faster than the
+       server accepts data.
+
+       Only the records of calls the server reports "ok" count as
+       delivered. Records of other failed calls are queued again at the
+       end of the spool and retried by the next drain(). Authentication
+       failures, and error responses that resending could fix, stop the
+       drain without removing anything from the spool."""
+
+    def __init__(self, spool, sock, address, builder, mid=None, max_payload=MAX_BATCH_PAYLOAD):
+        self.spool = spool
+        self.sock = sock
+        self.address = address
+        self.builder = builder
+        self.mid = random.randint(0, 0xFFFF) if mid is None else mid
+        self.max_payload = max_payload
+        self.rejected = 0
+        """Records dropped because the server refused their batch as
+           malformed (4.00 Bad Request, 4.02 Bad Option)."""
+        self.requeued = 0
+        """Records queued again because their call did not succeed."""
+        self.unauthorized = False
+        """True if the last drain() stopped because the server refused the CIK."""
+
+    def drain(self, max_batches=None, max_records=256):
+        """Send pending records until the spool is empty, a batch fails,
+           or max_batches have been sent. Returns the number of records
+           delivered."""
+        delivered = 0
+        batches = 0
+        requeued = set()
+        self.unauthorized = False
+        while max_batches is None or batches < max_batches:
+            (records, _) = self.spool.read(max_records)
+            # Records queued again by this drain are left for the next one.
+            for (index, record) in enumerate(records):
+                if cborstream.dumps(list(record)) in requeued:
+                    records = records[:index]
+                    break
+            if not records:
+                break
+            count = self._fitBatch(records)
+            (records, position) = self.spool.read(count)
+            (calls, msg) = self._batchMessage(records)
+            response = self._exchange(msg)
+            if response is None:
+                break
+            if not coap.isSuccessful(response.code):
+                if response.code in (coap.UNAUTHORIZED, coap.FORBIDDEN):
+                    self.unauthorized = True
+                    break
+                if response.code == coap.REQUEST_ENTITY_TOO_LARGE and count > 1:
+                    self.max_payload = max(self.max_payload // 2, 1)
+                    continue
+                if response.code not in (coap.BAD_REQUEST, coap.BAD_OPTION):
+                    break
+                self.rejected += count
+                self.spool.commit(position)
+                batches += 1
+                continue
+            try:
+                statuses = _callStatuses(rpc.decodeResponse(response))
+            except ValueError:
+                break
+            if statuses is None or AUTH_FAILURE_STATUSES.intersection(statuses.values()):
+                self.unauthorized = True
+                break
+            failed = [record for (call_id, alias_records) in calls.items()
+                      if statuses.get(call_id) != 'ok' for record in alias_records]
+            for (alias, timestamp, value) in failed:
+                self.spool.append(alias, value, timestamp)
+                requeued.add(cborstream.dumps([alias, timestamp, value]))
+            self.requeued += len(failed)
+            delivered += count - len(failed)
+            self.spool.commit(position)
+            batches += 1
+        return delivered
+
+    def _fitBatch(self, records):
+        """Number of leading records that fit within max_payload."""
+        size = 0
+        aliases = set()
+        for (index, (alias, timestamp, value)) in enumerate(records):
+            size += len(cborstream.dumps([timestamp, value]))
+            if alias not in aliases:
+                aliases.add(alias)
+                size += len(alias) + _CALL_OVERHEAD
+            if size > self.max_payload and index > 0:
+                return index
+        return len(records)
+
+    def _batchMessage(self, records):
+        """Return ({call id: records}, message) for one record call per alias."""
+        by_alias = {}
+        for record in records:
+            by_alias.setdefault(record[0], []).append(record)
+        calls = {}
+        encoded = []
+        for (call_id, (alias, alias_records)) in enumerate(by_alias.items(), 1):
+            calls[call_id] = alias_records
+            points = [[timestamp, value] for (_, timestamp, value) in alias_records]
+            encoded.append(self.builder.call("record", [rpc.aliasArgument(alias), points, {}], call_id))
+        self.mid = (self.mid + 1) & 0xFFFF
+        msg = self.builder.message(encoded, self.mid)
+        msg.token = struct.pack('!H', self.mid)
+        return (calls, msg)
+
+    def _exchange(self, msg):
+        """Send a CON request with retransmission and return the response
+           Message, or None if no response arrived."""
+        data = msg.encode()
+        timeout = coap.ACK_TIMEOUT * random.uniform(1, coap.ACK_RANDOM_FACTOR)
+        acknowledged = False
+        for _ in range(coap.MAX_RETRANSMIT + 1):
+            try:
+                self.sock.sendto(data, self.address)
+            except (OSError, socket.error):
+                return None
+            deadline = time.time() + timeout
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.sock.settimeout(remaining)
+                try:
+                    raw, addr = self.sock.recvfrom(2048)
+                    response = coap.Message.decode(raw, remote=addr)
+                except (socket.timeout, ValueError, IndexError, struct.error):
+                    continue
+                except (OSError, socket.error):
+                    return None
+                if response.mid == msg.mid and response.code == coap.EMPTY:
+                    if response.mtype == coap.RST:
+                        return None
+                    # Separate response will follow; stop retransmitting.
+                    acknowledged = True
+                    deadline = time.time() + coap.MAX_RTT
+                    continue
+                if response.token != msg.token or response.code == coap.EMPTY:
+                    continue
+                if response.mtype == coap.CON:
+                    self.sock.sendto(coap.Message(mtype=coap.ACK, mid=response.mid).encode(), addr)
+                return response
+            if acknowledged:
+                return None
+            timeout *= 2
+        return None
+
+
+def _callStatuses(body):
+    """{call id: status} from a decoded /rpc response, or None if the whole
+       request was refused (an error object in place of the call list)."""
+    if not isinstance(body, list):
+        return None
+    return dict((call.get('id'), call.get('status')) for call in body if isinstance(call, dict))
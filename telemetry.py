@@ -0,0 +1,184 @@
+"""
+High-Throughput Telemetry
+
+Fire-and-forget writes to the /1a API using non-confirmable messages. Each
+alias's header and options are encoded once into a template, so a send only
+patches in the Message ID and appends the payload; nothing waits for the
+network, so the send rate is bounded by the socket rather than by RTT.
+
+A sample of messages is sent confirmable to estimate the loss rate. When
+loss rises above a threshold the sender switches every message to CON with
+retransmission, and back to NON once loss has dropped well below it.
+
+A Message ID is not reused until its lifetime (NON_LIFETIME or
+EXCHANGE_LIFETIME) has passed, and at most max_outstanding confirmable
+messages are in flight; send() returns False when either would be violated.
+"""
+
+import binascii
+import collections
+import errno
+import random
+import socket
+import struct
+import time
+
+import coap
+import cborstream
+
+
+PROBE_EVERY = 20
+"""Send one confirmable probe for every this many messages."""
+
+PROBE_WINDOW = 50
+"""Number of most recent probes the loss estimate is computed over."""
+
+LOSS_THRESHOLD = 0.2
+"""Loss rate above which all messages are sent confirmable."""
+
+_MID = struct.Struct('!H')
+
+
+class TelemetrySender(object):
+    """Sends datapoints to /1a/<alias> as NON messages with sampled CON
+       probes. poll() must be called regularly to collect acknowledgements,
+       expire probes and, in CON mode, retransmit."""
+
+    def __init__(self, sock, address, cik, probe_every=PROBE_EVERY, window=PROBE_WINDOW,
+                 loss_threshold=LOSS_THRESHOLD, max_outstanding=coap.NSTART, clock=time.time):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.address = address
+        self.cik = binascii.a2b_hex(cik) if isinstance(cik, str) else cik
+        self.probe_every = probe_every
+        self.loss_threshold = loss_threshold
+        self.max_outstanding = max_outstanding
+        self.clock = clock
+        self.confirmable = False
+        """True while loss is above the threshold and all sends are CON."""
+        self.sent = 0
+        self.dropped = 0
+        """Confirmable messages given up on after MAX_RETRANSMIT."""
+
+        self._mid = random.randint(0, 0xFFFF)
+        self._templates = {}
+        self._probes = collections.deque(maxlen=window)
+        self._pending = {}  # mid -> [data, deadline, timeout, attempts]
+        self._reusable = {}  # mid -> time it may be used again
+
+    def _loss(self):
+        if not self._probes:
+            return 0.0
+        return self._probes.count(False) / float(len(self._probes))
+    loss = property(_loss)
+
+    def _template(self, alias):
+        """Encoded header and options for a write to alias, with the
+           payload marker appended."""
+        template = self._templates.get(alias)
+        if template is None:
+            msg = coap.Message(mtype=coap.NON, mid=0, code=coap.POST)
+            msg.opt.uri_path = ('1a', alias) if alias is not None else ('1a', )
+            msg.opt.uri_query = (self.cik, )
+            template = self._templates[alias] = msg.encode() + b'\xff'
+        return template
+
+    def send(self, alias, value):
+        """Write value to alias and return True, or return False without
+           sending if no Message ID is free or, in CON mode, max_outstanding
+           messages await acknowledgement; poll() and try again later.
+           Values that are not bytes are sent as their text representation."""
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        elif not isinstance(value, (bytes, bytearray)):
+            value = str(value).encode('utf-8')
+        return self._send(self._template(alias), value)
+
+    def sendBatch(self, values):
+        """Write several aliases at once with a CBOR map in one message;
+           returns False if it could not be sent, as send() does."""
+        return self._send(self._template(None), cborstream.dumps(values))
+
+    def _send(self, template, payload):
+        now = self.clock()
+        mid = (self._mid + 1) & 0xFFFF
+        if self._reusable.get(mid, 0) > now:
+            return False
+        confirmable = self.confirmable or (self.sent + 1) % self.probe_every == 0
+        if confirmable and len(self._pending) >= self.max_outstanding:
+            if self.confirmable:
+                return False
+            confirmable = False  # skip this probe
+        self._mid = mid
+        self.sent += 1
+        data = bytearray(template)
+        if confirmable:
+            data[0] &= 0xCF  # CON is type 0
+        _MID.pack_into(data, 2, mid)
+        data += payload
+        data = bytes(data)
+        self._sendto(data, self.address)
+        if confirmable:
+            timeout = coap.ACK_TIMEOUT * random.uniform(1, coap.ACK_RANDOM_FACTOR)
+            self._pending[mid] = [data, now + timeout, timeout, 0]
+            self._reusable[mid] = now + coap.EXCHANGE_LIFETIME
+        else:
+            self._reusable[mid] = now + coap.NON_LIFETIME
+        return True
+
+    def _sendto(self, data, address):
+        """Send a datagram; one the kernel has no room for is treated as
+           lost."""
+        try:
+            self.sock.sendto(data, address)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                raise
+
+    def poll(self):
+        """Process received acknowledgements and expired confirmable
+           messages without blocking."""
+        while True:
+            try:
+                raw, addr = self.sock.recvfrom(2048)
+            except (socket.timeout, BlockingIOError):
+                break
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            try:
+                response = coap.Message.decode(raw, remote=addr)
+            except (ValueError, IndexError, struct.error):
+                continue
+            if response.mtype in (coap.ACK, coap.RST):
+                entry = self._pending.pop(response.mid, None)
+                if entry is not None and entry[3] == 0:
+                    self._probes.append(True)
+            elif response.mtype == coap.CON:
+                self._sendto(coap.Message(mtype=coap.ACK, mid=response.mid).encode(), addr)
+
+        now = self.clock()
+        for mid, entry in list(self._pending.items()):
+            (data, deadline, timeout, attempts) = entry
+            if now < deadline:
+                continue
+            if attempts == 0:
+                self._probes.append(False)
+            if not self.confirmable or attempts >= coap.MAX_RETRANSMIT:
+                del self._pending[mid]
+                if self.confirmable:
+                    self.dropped += 1
+                continue
+            entry[2] = timeout * 2
+            entry[1] = now + entry[2]
+            entry[3] = attempts + 1
+            self._sendto(data, self.address)
+        self._updateMode()
+
+    def _updateMode(self):
+        loss = self.loss
+        if not self.confirmable and loss > self.loss_threshold:
+            self.confirmable = True
+        elif self.confirmable and loss < self.loss_threshold / 2:
+            self.confirmable = False
@@ -0,0 +1,118 @@
+"""
+Tests for the incremental CBOR decoder and encoder.
+"""
+
+import binascii
+import unittest
+
+import cborstream
+
+
+def decode(data, chunk=None, emit=None):
+    """Feed data in chunks of chunk bytes; return (decoder, emitted items)."""
+    decoder = cborstream.IncrementalDecoder(emit)
+    emitted = []
+    step = chunk or len(data) or 1
+    for pos in range(0, len(data), step):
+        emitted.extend(decoder.feed(data[pos:pos + step]))
+    return decoder, emitted
+
+
+# Examples from RFC 7049 appendix A.
+EXAMPLES = [('00', 0),
+            ('17', 23),
+            ('1818', 24),
+            ('1903e8', 1000),
+            ('1b000000e8d4a51000', 1000000000000),
+            ('20', -1),
+            ('3903e7', -1000),
+            ('c249010000000000000000', 18446744073709551616),
+            ('3bffffffffffffffff', -18446744073709551616),
+            ('c349010000000000000000', -18446744073709551617),
+            ('f93c00', 1.0),
+            ('fa47c35000', 100000.0),
+            ('fb3ff199999999999a', 1.1),
+            ('f4', False),
+            ('f5', True),
+            ('f6', None),
+            ('4401020304', b'\x01\x02\x03\x04'),
+            ('6449455446', 'IETF'),
+            ('62c3bc', 'ü'),
+            ('83010203', [1, 2, 3]),
+            ('8301820203820405', [1, [2, 3], [4, 5]]),
+            ('a201020304', {1: 2, 3: 4}),
+            ('a26161016162820203', {'a': 1, 'b': [2, 3]}),
+            ('c074323031332d30332d32315432303a30343a30305a', '2013-03-21T20:04:00Z'),
+            ('5f42010243030405ff', b'\x01\x02\x03\x04\x05'),
+            ('7f657374726561646d696e67ff', 'streaming'),
+            ('9fff', []),
+            ('9f018202039f0405ffff', [1, [2, 3], [4, 5]]),
+            ('83018202039f0405ff', [1, [2, 3], [4, 5]]),
+            ('bf61610161629f0203ffff', {'a': 1, 'b': [2, 3]}),
+            ('bf6346756ef563416d7421ff', {'Fun': True, 'Amt': -2})]
+
+
+class IncrementalDecoderTest(unittest.TestCase):
+
+    def testExamples(self):
+        for (encoded, value) in EXAMPLES:
+            data = binascii.a2b_hex(encoded)
+            (decoder, _) = decode(data)
+            self.assertTrue(decoder.complete, encoded)
+            self.assertEqual(decoder.value, value, encoded)
+
+    def testEveryChunkBoundary(self):
+        for (encoded, value) in EXAMPLES:
+            data = binascii.a2b_hex(encoded)
+            for split in range(len(data) + 1):
+                decoder = cborstream.IncrementalDecoder()
+                decoder.feed(data[:split])
+                decoder.feed(data[split:])
+                self.assertTrue(decoder.complete, (encoded, split))
+                self.assertEqual(decoder.value, value, (encoded, split))
+
+    def testIncompleteDocument(self):
+        (decoder, _) = decode(binascii.a2b_hex('8301820203'), chunk=1)
+        self.assertFalse(decoder.complete)
+
+    def testEmittedPaths(self):
+        data = cborstream.dumps([{'id': 1, 'result': [[10, 1.5], [11, 2.5]]},
+                                 {'id': 2, 'result': []}])
+        emit = lambda path: len(path) == 1 or (len(path) == 3 and path[1] == 'result')
+        (decoder, emitted) = decode(data, chunk=3, emit=emit)
+        self.assertEqual(emitted, [((0, 'result', 0), [10, 1.5]),
+                                   ((0, 'result', 1), [11, 2.5]),
+                                   ((0, ), {'id': 1, 'result': []}),
+                                   ((1, ), {'id': 2, 'result': []})])
+        # Emitted items are not kept in their parent.
+        self.assertEqual(decoder.value, [])
+
+    def testMapKeysAreNotEmitted(self):
+        (_, emitted) = decode(cborstream.dumps({'a': {'b': 1}}), emit=lambda path: True)
+        self.assertEqual([path for (path, _) in emitted], [('a', 'b'), ('a', ), ()])
+
+    def testTrailingData(self):
+        decoder = cborstream.IncrementalDecoder()
+        self.assertRaises(cborstream.CBORDecodeError, decoder.feed, b'\x01\x02')
+        decoder = cborstream.IncrementalDecoder()
+        decoder.feed(b'\x01')
+        self.assertRaises(cborstream.CBORDecodeError, decoder.feed, b'\x02')
+
+    def testMalformed(self):
+        for encoded in ('ff', '1c', '5f01ff', '9f5f6161ffff', 'bf01ff'):
+            self.assertRaises(cborstream.CBORDecodeError, decode, binascii.a2b_hex(encoded))
+
+
+class DumpsTest(unittest.TestCase):
+
+    def testShortestForm(self):
+        for (encoded, value) in EXAMPLES[:7] + EXAMPLES[13:23]:
+            self.assertEqual(binascii.b2a_hex(cborstream.dumps(value)).decode('ascii'), encoded)
+
+    def testRawIsSpliced(self):
+        raw = cborstream.Raw(cborstream.dumps({'alias': 'temp'}))
+        self.assertEqual(cborstream.dumps([raw, 1]), cborstream.dumps([{'alias': 'temp'}, 1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
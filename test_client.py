@@ -0,0 +1,151 @@
+"""
+Loopback tests for the thread-safe client.
+"""
+
+import socket
+import threading
+import unittest
+
+import coap
+import client
+import scheduler
+import server
+
+
+class _Blob(server.Resource):
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def render_GET(self, request):
+        return coap.Message(code=coap.CONTENT, payload=self.payload)
+
+
+class _RawServer(object):
+    """Hands each request to handler(request), which returns a list of
+       Messages to send back."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.2)
+        self.address = self.sock.getsockname()
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+    def _serve(self):
+        while self.running:
+            try:
+                data, remote = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            request = coap.Message.decode(data)
+            self.requests.append(request)
+            for response in self.handler(request):
+                self.sock.sendto(response.encode(), remote)
+
+
+def _ack(request, payload=b'ok'):
+    return coap.Message(mtype=coap.ACK, mid=request.mid, code=coap.CONTENT, token=request.token,
+                        payload=payload)
+
+
+class ClientTest(unittest.TestCase):
+
+    def testBlockwiseResponse(self):
+        payload = bytes(range(256)) * 20
+        tree = server.ResourceTree()
+        tree.putChild(('blob', ), _Blob(payload))
+        srv = server.Server(tree, address=('127.0.0.1', 0))
+        thread = threading.Thread(target=srv.serveForever)
+        thread.start()
+        try:
+            with client.Client(address=srv.sock.getsockname(), block_policy=coap.BlockSizePolicy()) as c:
+                response = c.get(('blob', ), timeout=5)
+                self.assertEqual(response.payload, payload)
+                self.assertIsNone(response.opt.block2)
+                self.assertEqual(response.transmissions, 5)
+                self.assertEqual(response.retransmissions, 0)
+        finally:
+            srv.stop()
+            thread.join()
+            srv.sock.close()
+
+    def testRetransmission(self):
+        dropped = []
+
+        def handler(request):
+            if not dropped:
+                dropped.append(request)
+                return []
+            return [_ack(request)]
+        raw = _RawServer(handler)
+        try:
+            with client.Client(address=raw.address) as c:
+                response = c.get(('x', ), timeout=10)
+            self.assertEqual(response.payload, b'ok')
+            self.assertEqual((response.transmissions, response.retransmissions), (2, 1))
+            self.assertEqual(raw.requests[0].encode(), raw.requests[1].encode())
+        finally:
+            raw.close()
+
+    def testTimeout(self):
+        raw = _RawServer(lambda request: [])
+        try:
+            with client.Client(address=raw.address) as c:
+                future = c.request(coap.Message(code=coap.GET), max_retransmit=0)
+                self.assertRaises(client.ExchangeTimeout, future.result, 10)
+            self.assertEqual(len(raw.requests), 1)
+        finally:
+            raw.close()
+
+    def testResetFailsImmediately(self):
+        raw = _RawServer(lambda request: [coap.Message(mtype=coap.RST, mid=request.mid)])
+        try:
+            with client.Client(address=raw.address) as c:
+                future = c.request(coap.Message(code=coap.GET))
+                self.assertRaises(client.ExchangeReset, future.result, 1)
+        finally:
+            raw.close()
+
+    def testStaleAckIsIgnored(self):
+        def handler(request):
+            # An ACK for an earlier Message ID carrying the same token.
+            stale = _ack(request, b'stale')
+            stale.mid = (request.mid - 1) & 0xFFFF
+            return [stale, _ack(request)]
+        raw = _RawServer(handler)
+        try:
+            with client.Client(address=raw.address) as c:
+                self.assertEqual(c.get(('x', ), timeout=5).payload, b'ok')
+        finally:
+            raw.close()
+
+    def testPriority(self):
+        raw = _RawServer(lambda request: [_ack(request, request.payload)])
+        try:
+            with client.Client(address=raw.address) as c:
+                futures = [c.request(coap.Message(code=coap.POST, payload=b'bulk'), priority=scheduler.BULK)
+                           for _ in range(3)]
+                futures.append(c.request(coap.Message(code=coap.POST, payload=b'urgent'),
+                                         priority=scheduler.URGENT))
+                for future in futures:
+                    future.result(5)
+            # With NSTART 1 at most the first BULK request can be sent
+            # before the URGENT one is queued; it overtakes the rest.
+            self.assertIn([r.payload for r in raw.requests],
+                          ([b'urgent', b'bulk', b'bulk', b'bulk'], [b'bulk', b'urgent', b'bulk', b'bulk']))
+        finally:
+            raw.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+"""
+Round-trip tests for the COAP message codec.
+"""
+
+import unittest
+
+import coap
+
+
+def roundTrip(msg):
+    return coap.Message.decode(msg.encode())
+
+
+class OptionEncodingTest(unittest.TestCase):
+
+    def testExtendedDeltaAndLength(self):
+        msg = coap.Message(mtype=coap.CON, mid=0x1234, code=coap.GET, token=b'\x01\x02')
+        # One-byte (13..268) and two-byte (269+) extended deltas and lengths.
+        msg.opt.addOption(coap.StringOption(20, b'a' * 12))
+        msg.opt.addOption(coap.StringOption(40, b'b' * 13))
+        msg.opt.addOption(coap.StringOption(400, b'c' * 268))
+        msg.opt.addOption(coap.StringOption(1000, b'd' * 269))
+        decoded = roundTrip(msg)
+        self.assertEqual(decoded.mid, 0x1234)
+        self.assertEqual(decoded.token, b'\x01\x02')
+        for number, value in ((20, b'a' * 12), (40, b'b' * 13), (400, b'c' * 268), (1000, b'd' * 269)):
+            self.assertEqual([option.value for option in decoded.opt.getOption(number)], [value])
+
+    def testExtendedFieldBoundaries(self):
+        for value in (0, 12, 13, 268, 269, 65803):
+            (nibble, extended) = coap.writeExtendedFieldValue(value)
+            self.assertEqual(coap.readExtendedFieldValue(nibble, extended, 0), (value, len(extended)))
+        self.assertRaises(ValueError, coap.writeExtendedFieldValue, 65804)
+        self.assertRaises(ValueError, coap.readExtendedFieldValue, 14, b'\x00', 0)
+
+    def testBlockZero(self):
+        msg = coap.Message(mtype=coap.CON, mid=1, code=coap.GET)
+        msg.opt.block2 = (0, 0, 0)
+        data = msg.encode()
+        self.assertEqual(data[4:], b'\xd0\x0a')  # Block2 (13 + 10) with an empty value
+        self.assertEqual(tuple(coap.Message.decode(data).opt.block2), (0, 0, 0))
+
+    def testBlockValues(self):
+        for value in ((0, 1, 6), (1, 0, 2), (4095, 1, 6), (1048575, 0, 0)):
+            msg = coap.Message(mtype=coap.CON, mid=1, code=coap.POST)
+            msg.opt.block1 = value
+            self.assertEqual(tuple(roundTrip(msg).opt.block1), value)
+
+    def testStringBytesAndIntValues(self):
+        msg = coap.Message(mtype=coap.CON, mid=1, code=coap.GET)
+        msg.opt.uri_path = ('1a', b'raw\xff', 5)
+        msg.opt.uri_query = (b'\x00\x01', 'k=v')
+        decoded = roundTrip(msg)
+        self.assertEqual(decoded.opt.uri_path, [b'1a', b'raw\xff', b'5'])
+        self.assertEqual(decoded.opt.uri_query, [b'\x00\x01', b'k=v'])
+
+    def testMutableSegments(self):
+        msg = coap.Message(mtype=coap.CON, mid=1, code=coap.GET)
+        msg.opt.uri_path = (bytearray(b'1a'), memoryview(b'temp'))
+        msg.opt.uri_query = (bytearray(b'\xa3\x00'), )
+        decoded = roundTrip(msg)
+        self.assertEqual(decoded.opt.uri_path, [b'1a', b'temp'])
+        self.assertEqual(decoded.opt.uri_query, [b'\xa3\x00'])
+        with self.assertRaises(ValueError):
+            msg.opt.uri_path = bytearray(b'1a')
+
+    def testUintValues(self):
+        for value in (0, 1, 255, 256, 65535, 2 ** 32 - 1):
+            msg = coap.Message(mtype=coap.CON, mid=1, code=coap.GET)
+            msg.opt.content_format = value if value < 65536 else 0
+            msg.opt.max_age = value
+            decoded = roundTrip(msg)
+            self.assertEqual(decoded.opt.max_age, value)
+            self.assertEqual(decoded.opt.content_format, value if value < 65536 else 0)
+
+    def testAccept(self):
+        msg = coap.Message(mtype=coap.CON, mid=1, code=coap.GET)
+        msg.opt.accept = 50
+        data = msg.encode()
+        self.assertEqual(data[4:], b'\xd1\x04\x32')
+        self.assertEqual(coap.Message.decode(data).opt.accept, 50)
+
+    def testPayload(self):
+        msg = coap.Message(mtype=coap.NON, mid=7, code=coap.CONTENT, payload=b'\xff\x00payload')
+        decoded = roundTrip(msg)
+        self.assertEqual(decoded.payload, b'\xff\x00payload')
+        self.assertEqual(decoded.mtype, coap.NON)
+        self.assertEqual(decoded.code, coap.CONTENT)
+
+
+
+class ValidateTest(unittest.TestCase):
+
+    def testValidCodeSurvives(self):
+        self.assertEqual(coap.VALID, 67)
+        msg = coap.Message(mtype=coap.ACK, mid=3, code=coap.VALID)
+        self.assertEqual(roundTrip(msg).code, coap.VALID)
+
+    def testValidateAgreesWithDecode(self):
+        msg = coap.Message(mtype=coap.CON, mid=1, code=coap.GET, payload=b'x')
+        msg.opt.uri_path = ('1a', 'alias')
+        data = msg.encode()
+        self.assertEqual(coap.validate(data), coap.DATAGRAM_OK)
+        self.assertEqual(coap.validate(data[:3]), coap.REJECT_TRUNCATED_HEADER)
+        self.assertEqual(coap.validate(data[:-1]), coap.REJECT_EMPTY_PAYLOAD)
+        self.assertEqual(coap.validate(data[:-3]), coap.REJECT_TRUNCATED_OPTION)
+
+
+
+class MessagePoolTest(unittest.TestCase):
+
+    def message(self):
+        msg = coap.Message(mtype=coap.CON, mid=9, code=coap.POST, token=b'tk', payload=b'21.5')
+        msg.opt.uri_path = ('1a', 'temp')
+        msg.opt.uri_query = (b'\xa3\x00', )
+        msg.opt.content_format = 0
+        msg.opt.block2 = (3, 0, 4)
+        return msg
+
+    def testMatchesPlainDecode(self):
+        pool = coap.MessagePool()
+        data = self.message().encode()
+        for rawdata in (data, bytearray(data), data, bytearray(data)):
+            msg = pool.decode(rawdata)
+            self.assertEqual(msg.encode(), data)
+            self.assertEqual(msg.opt.uri_path, [b'1a', b'temp'])
+            self.assertEqual(tuple(msg.opt.block2), (3, 0, 4))
+            pool.release(msg)
+
+    def testReuse(self):
+        pool = coap.MessagePool()
+        data = self.message().encode()
+        first = pool.decode(data)
+        temp = first.opt.getOption(coap.URI_PATH)[1]
+        pool.release(first)
+        second = pool.decode(data)
+        self.assertIs(second, first)
+        # Repeated string options are shared rather than decoded again.
+        self.assertIs(second.opt.getOption(coap.URI_PATH)[1], temp)
+        pool.release(second)
+        other = coap.Message(mtype=coap.NON, mid=10, code=coap.GET)
+        self.assertEqual(pool.decode(other.encode()).encode(), other.encode())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+"""
+Tests for the forward proxy's request collapsing and cache.
+"""
+
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+
+import coap
+import client
+import proxy
+import server
+
+
+class _Origin(server.Resource):
+    """Answers GET with its payload, either at once or, when hold is set,
+       through Futures the test resolves."""
+
+    isLeaf = True
+
+    def __init__(self, hold=False):
+        self.hold = hold
+        self.requests = []
+        self.waiting = []
+
+    def render_GET(self, request):
+        self.requests.append(request)
+        if not self.hold:
+            return coap.Message(code=coap.CONTENT, payload=b'42')
+        future = Future()
+        self.waiting.append(future)
+        return future
+
+
+def _start(tree, proxy=None):
+    srv = server.Server(tree, address=('127.0.0.1', 0), proxy=proxy)
+    thread = threading.Thread(target=srv.serveForever)
+    thread.start()
+    return srv, thread
+
+
+def _waitFor(predicate, timeout=5.0):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+
+class ForwardProxyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.origin = _Origin()
+        tree = server.ResourceTree()
+        tree.putChild(('1a', ), self.origin)
+        (self.origin_server, self.origin_thread) = _start(tree)
+        self.origin_port = self.origin_server.sock.getsockname()[1]
+        self.proxy = proxy.ForwardProxy(upstream=client.Client())
+        (self.proxy_server, self.proxy_thread) = _start(server.ResourceTree(), self.proxy)
+        self.client = client.Client(address=self.proxy_server.sock.getsockname(), nstart=8)
+
+    def tearDown(self):
+        self.client.close()
+        self.proxy.upstream.close()
+        for (srv, thread) in ((self.proxy_server, self.proxy_thread), (self.origin_server, self.origin_thread)):
+            srv.stop()
+            thread.join()
+            srv.sock.close()
+
+    def proxyUri(self, path):
+        return 'coap://127.0.0.1:{}{}'.format(self.origin_port, path)
+
+    def get(self, path):
+        msg = coap.Message(code=coap.GET)
+        msg.opt.proxy_uri = self.proxyUri(path)
+        return self.client.request(msg)
+
+    def testCollapsesConcurrentRequests(self):
+        self.origin.hold = True
+        futures = [self.get('/1a/temp') for _ in range(5)]
+        _waitFor(lambda: self.proxy.collapsed == 4 and self.origin.waiting)
+        self.assertEqual(self.proxy.upstream_requests, 1)
+        self.origin.waiting[0].set_result(coap.Message(code=coap.CONTENT, payload=b'21.5'))
+        for future in futures:
+            response = future.result(5)
+            self.assertEqual(response.code, coap.CONTENT)
+            self.assertEqual(response.payload, b'21.5')
+        self.assertEqual(len(self.origin.requests), 1)
+        # Later requests are served from the cache.
+        self.assertEqual(self.get('/1a/temp').result(5).payload, b'21.5')
+        self.assertEqual(self.proxy.cache_hits, 1)
+        self.assertEqual(len(self.origin.requests), 1)
+
+    def testDistinctResourcesAreNotCollapsed(self):
+        for path in ('/1a/temp', '/1a/humidity', '/1a/temp?a', '/1a/temp?b'):
+            self.assertEqual(self.get(path).result(5).payload, b'42')
+        self.assertEqual(self.proxy.upstream_requests, 4)
+        self.assertEqual(len(self.origin.requests), 4)
+
+    def testBinaryQueryAndProxySchemeShareCacheEntry(self):
+        self.assertEqual(self.get('/1a/temp?%A3%00').result(5).payload, b'42')
+        upstream = self.origin.requests[0]
+        self.assertEqual(upstream.opt.uri_path, [b'1a', b'temp'])
+        self.assertEqual(upstream.opt.uri_query, [b'\xa3\x00'])
+
+        msg = coap.Message(code=coap.GET)
+        msg.opt.proxy_scheme = 'coap'
+        msg.opt.uri_host = '127.0.0.1'
+        msg.opt.uri_port = self.origin_port
+        msg.opt.uri_path = ('1a', 'temp')
+        msg.opt.uri_query = (b'\xa3\x00', )
+        self.assertEqual(self.client.request(msg).result(5).payload, b'42')
+        self.assertEqual(self.proxy.cache_hits, 1)
+        self.assertEqual(len(self.origin.requests), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
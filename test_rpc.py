@@ -0,0 +1,91 @@
+"""
+Tests for the /rpc request builder and response helpers.
+"""
+
+import unittest
+
+import coap
+import cborstream
+import rpc
+
+try:
+    import cbor
+except ImportError:
+    cbor = None
+
+
+CIK = 'a32c85ba9dda45823be416246cf8b433baa068d7'
+
+CALLS = [('read', [{'alias': 'temp'}, {'limit': 1}], 1),
+         ('write', [{'alias': 'temp'}, 21.5], 2),
+         ('record', [{'alias': 'log'}, [[1400000000, 'x'], [1400000001, -7]], {}], 'batch-3'),
+         ('info', [{'alias': ''}, {'description': True, 'key': None}], 2 ** 40)]
+
+
+def expected(calls):
+    return {'auth': {'cik': CIK},
+            'calls': [{'procedure': p, 'arguments': a, 'id': i} for (p, a, i) in calls]}
+
+
+class RequestBuilderTest(unittest.TestCase):
+
+    def build(self, calls, alias_argument=False):
+        builder = rpc.RequestBuilder(CIK)
+        encoded = []
+        for (procedure, arguments, call_id) in calls:
+            if alias_argument:
+                arguments = [rpc.aliasArgument(arguments[0]['alias'])] + arguments[1:]
+            encoded.append(builder.call(procedure, arguments, call_id))
+        return builder.payload(encoded)
+
+    @unittest.skipIf(cbor is None, "cbor is not installed")
+    def testMatchesCborDumps(self):
+        for count in range(len(CALLS) + 1):
+            calls = CALLS[:count]
+            self.assertEqual(self.build(calls), cbor.dumps(expected(calls)))
+            self.assertEqual(self.build(calls, alias_argument=True), cbor.dumps(expected(calls)))
+
+    def testMatchesDumps(self):
+        self.assertEqual(self.build(CALLS, alias_argument=True), cborstream.dumps(expected(CALLS)))
+
+    def testRepeatedCallsReuseFragments(self):
+        builder = rpc.RequestBuilder(CIK)
+        first = builder.call('read', [rpc.aliasArgument('temp'), {}], 1)
+        second = builder.call('read', [rpc.aliasArgument('temp'), {}], 1)
+        self.assertEqual(first, second)
+        self.assertIs(rpc.aliasArgument('temp'), rpc.aliasArgument('temp'))
+
+    def testMessage(self):
+        builder = rpc.RequestBuilder(CIK)
+        msg = builder.message([builder.call('read', [rpc.aliasArgument('temp'), {}], 1)], mid=5)
+        decoded = coap.Message.decode(msg.encode())
+        self.assertEqual(decoded.code, coap.POST)
+        self.assertEqual(decoded.opt.uri_path, [b'rpc'])
+        self.assertEqual(decoded.opt.content_format, rpc.CONTENT_FORMAT_CBOR)
+        self.assertEqual(decoded.payload, msg.payload)
+
+
+class ResponseTest(unittest.TestCase):
+
+    def testDecodeResponse(self):
+        body = [{'id': 1, 'status': 'ok', 'result': [[1400000000, 20]]}]
+        response = coap.Message(code=coap.CONTENT, payload=cborstream.dumps(body))
+        self.assertEqual(rpc.decodeResponse(response), body)
+        self.assertRaises(ValueError, rpc.decodeResponse, coap.Message(code=coap.UNAUTHORIZED, payload=b'no'))
+        truncated = coap.Message(code=coap.CONTENT, payload=cborstream.dumps(body)[:-1])
+        self.assertRaises(cborstream.CBORDecodeError, rpc.decodeResponse, truncated)
+
+    def testIterResponseAcrossBlocks(self):
+        body = cborstream.dumps([{'id': 1, 'status': 'ok', 'result': [[1, 'a'], [2, 'b']]},
+                                 {'id': 2, 'status': 'ok'}])
+        chunks = [body[pos:pos + 5] for pos in range(0, len(body), 5)]
+        items = list(rpc.iterResponse(chunks, datapoints=True))
+        self.assertEqual(items, [((0, 'result', 0), [1, 'a']),
+                                 ((0, 'result', 1), [2, 'b']),
+                                 ((0, ), {'id': 1, 'status': 'ok', 'result': []}),
+                                 ((1, ), {'id': 2, 'status': 'ok'})])
+        self.assertRaises(cborstream.CBORDecodeError, list, rpc.iterResponse(chunks[:-1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
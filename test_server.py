@@ -0,0 +1,128 @@
+"""
+Loopback tests for the resource server.
+"""
+
+import socket
+import threading
+import unittest
+from concurrent.futures import Future
+
+import coap
+import server
+
+
+class _Counter(server.Resource):
+    """Counts POSTs; GET returns result, which the test may replace."""
+
+    def __init__(self):
+        self.posts = 0
+        self.result = coap.Message(code=coap.CONTENT, payload=b'x' * 3000)
+
+    def render_POST(self, request):
+        self.posts += 1
+        return coap.Message(code=coap.CHANGED, payload=str(self.posts).encode('ascii'))
+
+    def render_GET(self, request):
+        return self.result
+
+
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resource = _Counter()
+        tree = server.ResourceTree()
+        tree.putChild(('count', ), self.resource)
+        self.server = server.Server(tree, address=('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.server.serveForever)
+        self.thread.start()
+        self.address = self.server.sock.getsockname()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.settimeout(2.0)
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        self.server.sock.close()
+        self.sock.close()
+
+    def exchange(self, msg):
+        self.sock.sendto(msg.encode(), self.address)
+        return self.receive()
+
+    def receive(self):
+        return coap.Message.decode(self.sock.recvfrom(2048)[0])
+
+    def request(self, code, mid, block2=None):
+        msg = coap.Message(mtype=coap.CON, mid=mid, code=code, token=b'tk')
+        msg.opt.uri_path = ('count', )
+        if block2 is not None:
+            msg.opt.block2 = block2
+        return msg
+
+    def testDuplicateIsAnsweredFromCache(self):
+        first = self.exchange(self.request(coap.POST, 100))
+        again = self.exchange(self.request(coap.POST, 100))
+        other = self.exchange(self.request(coap.POST, 101))
+        self.assertEqual((first.mtype, first.mid, first.payload), (coap.ACK, 100, b'1'))
+        self.assertEqual(again.encode(), first.encode())
+        self.assertEqual(other.payload, b'2')
+        self.assertEqual(self.resource.posts, 2)
+
+    def testNotFound(self):
+        msg = self.request(coap.GET, 102)
+        msg.opt.uri_path = ('missing', )
+        self.assertEqual(self.exchange(msg).code, coap.NOT_FOUND)
+
+    def testBlockwiseResponse(self):
+        body = bytearray()
+        number = 0
+        while True:
+            response = self.exchange(self.request(coap.GET, 200 + number, block2=(number, 0, 6)))
+            block2 = response.opt.block2
+            self.assertEqual((block2.block_number, block2.size_exponent), (number, 6))
+            body += response.payload
+            if not block2.more:
+                break
+            number += 1
+        self.assertEqual(bytes(body), self.resource.result.payload)
+
+    def testSmallerBlocksKeepOffset(self):
+        self.sock.bind(('127.0.0.1', 0))
+        self.server.block_policy = coap.BlockSizePolicy()
+        self.server.block_policy.shrink(self.sock.getsockname(), 4)
+        response = self.exchange(self.request(coap.GET, 300, block2=(1, 0, 6)))
+        self.assertEqual(tuple(response.opt.block2), (4, 1, 4))
+
+    def testSeparateResponse(self):
+        future = self.resource.result = Future()
+        ack = self.exchange(self.request(coap.GET, 400))
+        self.assertEqual((ack.mtype, ack.mid, ack.code), (coap.ACK, 400, coap.EMPTY))
+        # The request's retransmission is answered with the same empty ACK.
+        self.assertEqual(self.exchange(self.request(coap.GET, 400)).encode(), ack.encode())
+        future.set_result(coap.Message(code=coap.CONTENT, payload=b'late'))
+        response = self.receive()
+        self.assertEqual((response.mtype, response.code, response.token, response.payload),
+                         (coap.CON, coap.CONTENT, b'tk', b'late'))
+        self.sock.sendto(coap.Message(mtype=coap.ACK, mid=response.mid).encode(), self.address)
+        self.sock.settimeout(coap.ACK_TIMEOUT * coap.ACK_RANDOM_FACTOR + 0.5)
+        self.assertRaises(socket.timeout, self.receive)
+
+    def testSeparateResponseIsRetransmitted(self):
+        future = self.resource.result = Future()
+        self.exchange(self.request(coap.GET, 500))
+        future.set_result(coap.Message(code=coap.CONTENT, payload=b'late'))
+        response = self.receive()
+        self.sock.settimeout(coap.ACK_TIMEOUT * coap.ACK_RANDOM_FACTOR + 0.5)
+        self.assertEqual(self.receive().encode(), response.encode())
+
+    def testBadRenderResult(self):
+        self.resource.result = 'not a message'
+        self.assertEqual(self.exchange(self.request(coap.GET, 600)).code, coap.INTERNAL_SERVER_ERROR)
+        future = self.resource.result = Future()
+        self.exchange(self.request(coap.GET, 601))
+        future.set_result(None)
+        self.assertEqual(self.receive().code, coap.INTERNAL_SERVER_ERROR)
+
+
+if __name__ == '__main__':
+    unittest.main()
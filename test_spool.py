@@ -0,0 +1,178 @@
+"""
+Tests for the on-disk write spool and its /rpc drainer.
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+
+import coap
+import cborstream
+import rpc
+import spool
+
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def testReadAndCommit(self):
+        with spool.Spool(self.directory) as queue:
+            self.assertTrue(queue.empty)
+            for i in range(5):
+                queue.append('temp', i, 1000 + i)
+            (records, position) = queue.read(3)
+            self.assertEqual(records, [('temp', 1000, 0), ('temp', 1001, 1), ('temp', 1002, 2)])
+            # Reading does not consume.
+            self.assertEqual(queue.read(3)[0], records)
+            queue.commit(position)
+            self.assertEqual(queue.read()[0], [('temp', 1003, 3), ('temp', 1004, 4)])
+
+    def testRestartKeepsUncommittedRecords(self):
+        with spool.Spool(self.directory) as queue:
+            for i in range(4):
+                queue.append('temp', [i, 'x'], 1000 + i)
+            queue.commit(queue.read(1)[1])
+        with spool.Spool(self.directory) as queue:
+            self.assertEqual(queue.read()[0], [('temp', 1001, [1, 'x']), ('temp', 1002, [2, 'x']),
+                                               ('temp', 1003, [3, 'x'])])
+            queue.append('temp', 4, 1004)
+            self.assertEqual(len(queue.read()[0]), 4)
+
+    def testTornRecordIsDiscarded(self):
+        with spool.Spool(self.directory) as queue:
+            queue.append('temp', 1, 1000)
+            queue.append('temp', 2, 1001)
+            offset = queue._write_offset
+        # Corrupt the last record's payload as a crash mid-write would.
+        path = os.path.join(self.directory, sorted(os.listdir(self.directory))[0])
+        with open(path, 'r+b') as f:
+            f.seek(offset - 1)
+            f.write(b'\xAA')
+        with spool.Spool(self.directory) as queue:
+            self.assertEqual(queue.read()[0], [('temp', 1000, 1)])
+
+    def testRolloverAcrossSegments(self):
+        with spool.Spool(self.directory, segment_size=256, max_segments=8) as queue:
+            for i in range(40):
+                queue.append('temp', i, 1000 + i)
+            self.assertGreater(len(queue._segments), 1)
+            self.assertEqual([value for (_, _, value) in queue.read()[0]], list(range(40)))
+            queue.commit(queue.read(30)[1])
+            self.assertEqual([value for (_, _, value) in queue.read()[0]], list(range(30, 40)))
+            self.assertLessEqual(len(queue._segments), 3)
+
+    def testFullSpoolDropsOldestSegment(self):
+        with spool.Spool(self.directory, segment_size=256, max_segments=2) as queue:
+            for i in range(60):
+                queue.append('temp', i, 1000 + i)
+            self.assertGreater(queue.dropped_segments, 0)
+            values = [value for (_, _, value) in queue.read()[0]]
+            self.assertEqual(values, list(range(values[0], 60)))
+
+
+class _RecordServer(object):
+    """Answers /rpc record batches; calls for aliases in bad fail."""
+
+    def __init__(self, code=coap.CHANGED, bad=()):
+        self.code = code
+        self.bad = set(bad)
+        self.points = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.settimeout(0.2)
+        self.address = self.sock.getsockname()
+        self.running = True
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.start()
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+        self.sock.close()
+
+    def _serve(self):
+        while self.running:
+            try:
+                data, remote = self.sock.recvfrom(4096)
+            except socket.timeout:
+                continue
+            request = coap.Message.decode(data)
+            decoder = cborstream.IncrementalDecoder()
+            decoder.feed(request.payload)
+            body = []
+            for call in decoder.value['calls']:
+                alias = call['arguments'][0]['alias']
+                if alias in self.bad:
+                    body.append({'id': call['id'], 'status': 'invalid'})
+                else:
+                    self.points.extend((alias, timestamp, value) for (timestamp, value) in call['arguments'][1])
+                    body.append({'id': call['id'], 'status': 'ok'})
+            payload = cborstream.dumps(body) if coap.isSuccessful(self.code) else b'refused'
+            response = coap.Message(mtype=coap.ACK, mid=request.mid, code=self.code,
+                                    token=request.token, payload=payload)
+            self.sock.sendto(response.encode(), remote)
+
+
+class SpoolDrainerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = spool.Spool(self.directory)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def tearDown(self):
+        self.sock.close()
+        self.queue.close()
+        shutil.rmtree(self.directory)
+
+    def drainer(self, server, **kwargs):
+        return spool.SpoolDrainer(self.queue, self.sock, server.address,
+                                  rpc.RequestBuilder('ab' * 20), **kwargs)
+
+    def testDrainsInBatches(self):
+        server = _RecordServer()
+        try:
+            for i in range(100):
+                self.queue.append('temp' if i % 2 else 'humidity', i, 1000 + i)
+            drainer = self.drainer(server, max_payload=256)
+            self.assertEqual(drainer.drain(), 100)
+            self.assertTrue(self.queue.empty)
+            self.assertEqual(sorted(value for (_, _, value) in server.points), list(range(100)))
+        finally:
+            server.close()
+
+    def testFailedCallsAreRequeued(self):
+        server = _RecordServer(bad=['missing'])
+        try:
+            for i in range(10):
+                self.queue.append('missing' if i % 5 == 0 else 'temp', i, 1000 + i)
+            drainer = self.drainer(server)
+            self.assertEqual(drainer.drain(), 8)
+            self.assertEqual(drainer.requeued, 2)
+            self.assertEqual(self.queue.read()[0], [('missing', 1000, 0), ('missing', 1005, 5)])
+        finally:
+            server.close()
+
+    def testUnauthorizedKeepsRecords(self):
+        server = _RecordServer(code=coap.UNAUTHORIZED)
+        try:
+            for i in range(5):
+                self.queue.append('temp', i, 1000 + i)
+            drainer = self.drainer(server)
+            self.assertEqual(drainer.drain(), 0)
+            self.assertTrue(drainer.unauthorized)
+            self.assertEqual(len(self.queue.read()[0]), 5)
+        finally:
+            server.close()
+
+
+if __name__ == '__main__':
+    unittest.main()